@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import lib_process_data as lpd
 import numpy
-from latqcdtools.statistics import bootstr
 import argparse
 import scipy.optimize
 import scipy.interpolate
@@ -199,10 +198,8 @@ def do_cont_extr(args, g2_ints, g2_err_ints, output_file, largest_min_muF_by_T):
 
     if args.calc_cont:
         for i in range(nflow):
-            fitparams, fitparams_err = bootstr.bootstr_from_gauss(fit_sample, data=data[i], data_std_dev=data_err[i], numb_samples=100,
-                                                                  sample_size=1, return_sample=False,
-                                                                  args=[1 / numpy.asarray(args.Nts) ** Ntexp * factor, data_err[i]],
-                                                                  parallelize=True, nproc=20)
+            fitparams, fitparams_err = lpd.gaussian_bootstrap(fit_sample, data[i], data_err[i], 100, "extrapolate_coupling/" + str(muF_by_T_samples[i]),
+                                                              nproc=20, args=[1 / numpy.asarray(args.Nts) ** Ntexp * factor, data_err[i]])
             chisqdof[i, 0] = fitparams[2]
             chisqdof[i, 1] = fitparams_err[2]
             cont[i, 0] = fitparams[1]
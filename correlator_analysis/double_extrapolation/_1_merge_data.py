@@ -1,24 +1,276 @@
 #!/usr/bin/env python3
 import numpy
+import os
 from os import listdir
+import concurrent.futures
+import collections
+import functools
+import tarfile
 import lib_process_data as lpd
 from natsort import natsorted
 
 # TODO write basepath and conf numbers to file for future reference where the data came from
 
 
-def get_flow_indices(flowradii, flowradii_ref):
-    indices = []
-    for f in range(len(flowradii)):
-        for g in range(len(flowradii_ref)):
-            if numpy.isclose(flowradii[f], flowradii_ref[g]):  # TODO check whether tolerance of isclose is small enough for our stepsizes.
-                indices.append(f)
-                break
-    return numpy.asarray(indices)
+class FlowTimeFilter:
+    """ selects the rows of a data file by their flow time (first column), either inside a window of flow radii sqrt(8 tau_F)/Nt or on a grid of
+    reference flow radii (an lpd.FloatGrid), or both. """
+    def __init__(self, nt, flowradius_window=None, flowradii_ref=None):
+        self.nt = nt
+        self.flowradius_window = flowradius_window
+        self.flowradii_ref = flowradii_ref
 
+    def __call__(self, flow_times):
+        flowradii = numpy.sqrt(8*flow_times)/self.nt
+        mask = numpy.ones(len(flowradii), dtype=bool)
+        if self.flowradius_window is not None:
+            mask &= (flowradii >= self.flowradius_window[0]) & (flowradii <= self.flowradius_window[1])
+        if self.flowradii_ref is not None:
+            mask &= self.flowradii_ref.contains(flowradii)
+        return mask
 
-def are_all_floats_of_a_in_b(a, b):
-    return numpy.array([numpy.isclose(val, b).any() for val in a]).all()
+
+def parse_datafile(path, row_filter=None):
+    with open(path, 'rb') as infile:
+        return parse_datafile_content(infile.read(), row_filter)
+
+
+def parse_datafile_content(content, row_filter=None):
+    """ fast replacement for numpy.loadtxt for the gradientFlow output files. all rows of a file have the same number of columns, so we can convert
+    the whole file in one go and only need to check the total number of values. returns numpy.empty((0,)) for empty files (like numpy.loadtxt)
+    and None for files that are corrupt, i.e. that do not have a fixed number of columns or contain something that is not a float.
+    if a row_filter (e.g. a FlowTimeFilter) is given, only the rows whose flow time it accepts are converted. """
+    lines = [line for line in content.splitlines() if line.strip() and not line.lstrip().startswith(b'#')]
+    if len(lines) > 0 and row_filter is not None:
+        try:
+            mask = row_filter(numpy.array([line.split(None, 1)[0] for line in lines], dtype=float))
+        except ValueError:
+            return None
+        lines = [line for line, keep in zip(lines, mask) if keep]
+    if len(lines) == 0:
+        return numpy.empty((0,))
+    ncols = len(lines[0].split())
+    try:
+        values = numpy.array(b" ".join(lines).split(), dtype=float)
+    except ValueError:
+        return None
+    if values.size != len(lines) * ncols:
+        return None
+    return values.reshape(len(lines), ncols)
+
+
+def parse_datafiles(paths, nproc, row_filter=None):
+    """ parse files concurrently and yield the results in the same order as the paths """
+    if nproc <= 1:
+        for path in paths:
+            yield parse_datafile(path, row_filter)
+    else:
+        chunksize = max(1, int(len(paths) / (nproc * 16)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as executor:
+            for result in executor.map(functools.partial(parse_datafile, row_filter=row_filter), paths, chunksize=chunksize):
+                yield result
+
+
+def is_archive(path):
+    return path.endswith((".tar", ".tar.gz", ".tgz"))
+
+
+def read_archive_members(archive, names):
+    """ yields the contents of the given members of a tar archive in the order in which they are stored in the archive, without extracting
+    anything to disk """
+    names = set(names)
+    with tarfile.open(archive, 'r:*') as tar:
+        for member in tar:
+            if member.name in names:
+                yield member.name, tar.extractfile(member).read()
+
+
+def _parse_archive_member(name_and_content, row_filter=None):
+    return name_and_content[0], parse_datafile_content(name_and_content[1], row_filter)
+
+
+def parse_archive_members(archive, names, nproc, row_filter=None):
+    """ parse members of a (compressed) tar archive concurrently and yield the results in the same order as the names. a compressed archive can
+    only be read sequentially, so members that are stored before their turn are kept in memory until they are needed. nothing needs to be kept
+    if the archive was created in natural order (e.g. with tar --sort=name). """
+    members = read_archive_members(archive, names)
+    parse = functools.partial(_parse_archive_member, row_filter=row_filter)
+    if nproc <= 1:
+        parsed = map(parse, members)
+    else:
+        parsed = _bounded_map(parse, members, nproc)
+    done = {}
+    next_index = 0
+    for name, result in parsed:
+        done[name] = result
+        while next_index < len(names) and names[next_index] in done:
+            yield done.pop(names[next_index])
+            next_index += 1
+    if next_index < len(names):
+        print("ERROR: could not read", names[next_index], "from", archive)
+        exit(1)
+
+
+def _bounded_map(function, iterable, nproc):
+    """ like executor.map, but the input is consumed lazily, such that only a few file contents are in memory at the same time """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 4 * nproc:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_XX_label(corr, legacy):
+    multiplicity = 1
+    if corr == "EE":
+        if legacy:
+            XX_label = "ColElecCorrTimeSlices_s"
+            multiplicity = -6
+        else:
+            XX_label = "ColElecCorrTimeSlices_naive_s"
+    elif corr == "BB":
+        XX_label = "ColMagnCorrTimeSlices_naive_s"
+    elif corr == "EE_clover":
+        XX_label = "ColElecCorrTimeSlices_clover_s"
+    elif corr == "BB_clover":
+        XX_label = "ColMagnCorrTimeSlices_clover_s"
+    return XX_label, multiplicity
+
+
+def match_datafile(datafile, full_prefixes, min_conf_nr):
+    """ returns (corr, confnum) if datafile is a data file of one of the correlators in full_prefixes with a conf number of at least min_conf_nr,
+    else None """
+    for corr, full_prefix in full_prefixes.items():
+        if datafile.startswith(full_prefix):
+            confnum = int(lpd.remove_left_of_last('_U', datafile))
+            return (corr, confnum) if confnum >= min_conf_nr else None
+    return None
+
+
+def group_datafiles(candidates, full_prefixes, min_conf_nr):
+    """ candidates is an iterable of (stream_folder, datafile, path). full_prefixes maps the correlators to the file name prefixes of their data
+    files. returns a list of (stream_folder, [(confnum, {corr: (datafile, path)}), ...]) in natural order of the streams and conf numbers. """
+    streams = {}
+    for stream_folder, datafile, path in candidates:
+        confs = streams.setdefault(stream_folder, {})
+        match = match_datafile(datafile, full_prefixes, min_conf_nr)
+        if match is not None:
+            corr, confnum = match
+            confs.setdefault(confnum, {})[corr] = (datafile, path)
+    return [(stream_folder, [(confnum, streams[stream_folder][confnum]) for confnum in sorted(streams[stream_folder])])
+            for stream_folder in natsorted(streams)]
+
+
+def list_datafiles(inputfolder, conftype, full_prefixes, min_conf_nr):
+    """ search all data files of the given correlators in one directory walk. see group_datafiles for the output. """
+    candidates = []
+    for stream_folder in listdir(inputfolder):
+        if stream_folder.startswith(conftype+"_"):
+            candidates.extend([(stream_folder, datafile, inputfolder+"/"+stream_folder+"/"+datafile) for datafile in listdir(inputfolder+"/"+stream_folder)])
+    return group_datafiles(candidates, full_prefixes, min_conf_nr)
+
+
+def list_archive_datafiles(archive, qcdtype, conftype, full_prefixes, min_conf_nr, nproc=None, row_filter=None):
+    """ same as list_datafiles, but for the members <qcdtype>/<conftype>/<conftype>_<stream>/<datafile> of a tar archive. also returns a dict that
+    maps the member names to (size, mtime_ns).
+    a compressed archive can only be read sequentially, so even listing the members decompresses all of it. therefore, if nproc is given, the data
+    files are also parsed (with nproc processes) in the same pass, and a dict that maps their member names to the parsed data is returned as well.
+    all parsed data is then kept in memory until it is merged. """
+    candidates = []
+    stats = {}
+
+    def read_members(tar):
+        for member in tar:
+            parts = member.name.split("/")
+            if member.isfile() and len(parts) >= 4 and parts[-4] == qcdtype and parts[-3] == conftype and parts[-2].startswith(conftype+"_"):
+                candidates.append((parts[-2], parts[-1], member.name))
+                stats[member.name] = (member.size, int(member.mtime * 10**9))
+                if nproc is not None and match_datafile(parts[-1], full_prefixes, min_conf_nr) is not None:
+                    yield member.name, tar.extractfile(member).read()
+
+    with tarfile.open(archive, 'r:*') as tar:
+        members = read_members(tar)
+        if nproc is None:
+            for _ in members:
+                pass
+            return group_datafiles(candidates, full_prefixes, min_conf_nr), stats
+        parse = functools.partial(_parse_archive_member, row_filter=row_filter)
+        parsed = dict(map(parse, members) if nproc <= 1 else _bounded_map(parse, members, nproc))
+    return group_datafiles(candidates, full_prefixes, min_conf_nr), stats, parsed
+
+
+def get_manifest_path(outputfolder, conftype):
+    return outputfolder+'manifest_'+conftype+'.dat'
+
+
+def read_manifest(filename):
+    """ returns a dict that maps (stream_folder, datafile) to (confnum, size, mtime, nrows, ncols, status, row), where row is the index of the
+    conf in the merged arrays (or None if the file did not end up in them) """
+    manifest = {}
+    row = 0
+    with open(filename) as infile:
+        for line in infile:
+            if line.startswith('#') or not line.strip():
+                continue
+            stream_folder, datafile, confnum, size, mtime, nrows, ncols, status = line.split()
+            manifest[(stream_folder, datafile)] = (int(confnum), int(size), int(mtime), int(nrows), int(ncols), status, row if status == "ok" else None)
+            if status == "ok":
+                row += 1
+    return manifest
+
+
+def write_manifest(filename, qcdtype, conftype, manifest_rows):
+    print("write "+filename)
+    with open(filename, 'w') as outfile:
+        outfile.write('# files that were ingested for '+qcdtype+' '+conftype+'. rows with status ok are the confs of the merged data, in the same order.\n')
+        outfile.write('# stream datafile confnum size mtime_ns nrows ncols status\n')
+        for stream_folder, datafile, confnum, size, mtime, nrows, ncols, status in manifest_rows:
+            outfile.write(" ".join([stream_folder, datafile, str(confnum), str(size), str(mtime), str(nrows), str(ncols), status])+'\n')
+
+
+merged_observables = ("XX_real", "XX_imag", "polyakov_real", "polyakov_imag")
+polyakov_observables = ("polyakov_real", "polyakov_imag")
+
+
+def create_merged_container(filename, nflow, capacity, nt_half, attrs, observables=merged_observables):
+    """ the observables are stored flow-time-major, (nflow, nconf, Ntau/2) and (nflow, nconf), so that single flow times and streams can be
+    memory-mapped cheaply later. capacity is an upper bound for nconf, the actual nconf is stored in the attrs once the merge is done. """
+    shapes = dict(XX_real=(nflow, capacity, nt_half), XX_imag=(nflow, capacity, nt_half), polyakov_real=(nflow, capacity), polyakov_imag=(nflow, capacity))
+    arrays = dict(flow_times=((nflow,), float), conf_nums=((capacity,), numpy.int64))
+    arrays.update({name: (shapes[name], float) for name in observables})
+    attrs = dict(attrs, nconf=0, conf_axis=dict(conf_nums=0, **{name: 1 for name in observables}))
+    return lpd.create_container(filename, arrays, attrs), attrs
+
+
+def check_datafile(tmp, datafile, shape, nt, excess_workaround, flowradii_ref):
+    """ compare a parsed data file to the shape of the first one and find the flow times that go into the merged data. flowradii_ref is None or an
+    lpd.FloatGrid of the reference flow radii. returns (status, data, flow indices), where status is ok, corrupt or skipped. """
+    shape_wrong_but_all_flowtimes_exist = False
+    if shape != tmp.shape:
+        these_flowradii = numpy.sqrt(8 * tmp[:, 0]) / nt
+        if excess_workaround and tmp.shape[1] == shape[1] and tmp.shape[0] > shape[0]:
+            print("INFO: discarding", tmp.shape[0]-shape[0], " flow times from the end")
+            tmp = tmp[:shape[0]]
+        elif flowradii_ref is not None and flowradii_ref.contains(these_flowradii).all():
+            shape_wrong_but_all_flowtimes_exist = True
+            # TODO check that all flowradii in flowradii are also in the ref file.
+        else:
+            print("error! shapes of input files don't match. ignoring", datafile)
+            print(shape, " (previous) vs ", tmp.shape, " (current file)")
+            return "corrupt", tmp, None
+
+    if flowradii_ref is not None or shape_wrong_but_all_flowtimes_exist:
+        flowradii = numpy.sqrt(8*tmp[:, 0])/nt
+        indices = flowradii_ref.indices_of(flowradii)
+        if len(indices) != len(flowradii_ref):
+            print("error! could not find all ref flowradii. skipping", datafile)
+            return "skipped", tmp, None
+    else:
+        indices = numpy.asarray(range(0, len(tmp)))
+    return "ok", tmp, indices
 
 
 def main():
@@ -26,10 +278,13 @@ def main():
     # it is assumed that the first data file that is read in is not corrupted and has the correct shape.
 
     # parse cmd line arguments
-    parser, requiredNamed = lpd.get_parser()
+    parser, requiredNamed = lpd.get_parser(allow_all_corrs=True, all_corrs_help="merge every correlator that is found in one pass. only the "
+                                           "confs for which the files of all these correlators are fine are kept, such that they share the same confs.")
     parser.add_argument('--acc_sts', help="accuracy and stepsize. format: acc0.000010_sts0.000010")
     requiredNamed.add_argument('--conftype', help="format: s096t20_b0824900 for quenched or s096t20_b0824900_m002022_m01011 for hisq", required=True)
-    parser.add_argument('--basepath', help="override default base input path with this one", type=str)
+    parser.add_argument('--basepath', type=str,
+                        help="override default base input path with this one. this can also be a (compressed) tar archive that contains "
+                             "<qcdtype>/<conftype>/<conftype>_<stream>/, which is then read without extracting it.")
     parser.add_argument('--legacy', help="use legacy file names and legacy multiplicity factor", action="store_true")
     parser.add_argument('--excess_workaround', help="ignore additional flow times at the end of later files", action="store_true")
     parser.add_argument('--reference_flowradii', default=None, type=str,
@@ -37,144 +292,268 @@ def main():
                              "the flowradii in this file have to be a subset of the ones you're trying to read in."
                              "useful if you want to combine different runs which different max flow time, or when you made noncritical copy-paste mistake for a few"
                              "flow times.")
+    parser.add_argument('--flowradius_window', nargs=2, type=float, default=None, metavar=('MIN', 'MAX'),
+                        help="only read and store the flow times whose flow radius sqrt(8 tau_F)/Nt (in units of 1/T) is inside this window. "
+                             "this can be combined with --reference_flowradii. choose it such that it covers what is needed later "
+                             "(lpd.get_relflow_range() times the largest tauT, and the max_FlowradiusBytauT cuts).")
     parser.add_argument('--min_conf_nr', help="ignore datafiles with conf number less than this.", default=0, type=int)
     parser.add_argument('--output_basepath', type=str, default="")
+    parser.add_argument('--nproc', type=int, default=1, help="number of processes that parse the data files concurrently")
+    parser.add_argument('--incremental', action="store_true",
+                        help="only parse files that are new or changed (size or mtime) since the last merge, according to the manifest file next to "
+                             "n_datafiles_<conftype>.dat. all other confs are copied from the existing merged data.")
 
     args = parser.parse_args()
 
     beta, ns, nt, nt_half = lpd.parse_conftype(args.conftype)
     fermions, temp, flowtype, _, _ = lpd.parse_qcdtype(args.qcdtype)
 
-    multiplicity = 1
-    if args.corr == "EE":
-        if args.legacy:
-            XX_label = "ColElecCorrTimeSlices_s"
-            multiplicity = -6
-        else:
-            XX_label = "ColElecCorrTimeSlices_naive_s"
-    elif args.corr == "BB":
-        XX_label = "ColMagnCorrTimeSlices_naive_s"
-    elif args.corr == "EE_clover":
-        XX_label = "ColElecCorrTimeSlices_clover_s"
-    elif args.corr == "BB_clover":
-        XX_label = "ColMagnCorrTimeSlices_clover_s"
-
     if not args.acc_sts:
         flow_prefix = flowtype+"_"
     else:
         flow_prefix = flowtype+"_"+args.acc_sts + "_"
 
-    if args.basepath:
+    archive = args.basepath if args.basepath and is_archive(args.basepath) else None
+    if archive:
+        inputfolder = archive + ":" + args.qcdtype + "/" + args.conftype + "/"
+    elif args.basepath:
         inputfolder = args.basepath + "/" + args.qcdtype + "/" + args.conftype + "/"
     else:
         inputfolder = lpd.get_raw_data_path(args.qcdtype, args.conftype)
 
-    outputfolder = lpd.get_merged_data_path(args.qcdtype, args.corr, args.conftype, args.output_basepath)
-    lpd.create_folder(outputfolder)
+    # with --corr all, every correlator is merged in the same pass over the files. only confs for which the files of all correlators are fine are
+    # merged, such that all correlators share the same confs and the polyakov loop only needs to be stored once.
+    corrs = ["EE", "BB", "EE_clover", "BB_clover"] if args.corr == "all" else [args.corr]
+    shared_polyakov = args.corr == "all"
+    XX_labels = {corr: get_XX_label(corr, args.legacy) for corr in corrs}
+    full_prefixes = {corr: flow_prefix+XX_labels[corr][0] for corr in corrs}
+    print("searching in subfolders of "+inputfolder + "   for  ", ", ".join([full_prefix+"*" for full_prefix in full_prefixes.values()]))
+
+    flowradii_ref = None
+    if args.reference_flowradii is not None:
+        flowradii_ref = lpd.FloatGrid(numpy.loadtxt(args.reference_flowradii))
+
+    # only the selected flow times are converted while parsing, all other rows are dropped right away
+    row_filter = None
+    row_selection = None
+    if args.flowradius_window is not None or flowradii_ref is not None:
+        row_filter = FlowTimeFilter(nt, args.flowradius_window, flowradii_ref)
+        row_selection = dict(flowradius_window=args.flowradius_window, reference_flowradii=None if flowradii_ref is None else flowradii_ref.grid.tolist())
+
+    # without --incremental every data file is parsed, which is done in the same pass over the archive as listing them
+    parsed_archive_members = None
+    if archive and args.incremental:
+        streams, stats = list_archive_datafiles(archive, args.qcdtype, args.conftype, full_prefixes, args.min_conf_nr)
+    elif archive:
+        streams, stats, parsed_archive_members = list_archive_datafiles(archive, args.qcdtype, args.conftype, full_prefixes, args.min_conf_nr,
+                                                                        args.nproc, row_filter)
+    else:
+        streams = list_datafiles(inputfolder, args.conftype, full_prefixes, args.min_conf_nr)
+        stats = {}
+    found_corrs = set([corr for _, confs in streams for _, files in confs for corr in files])
+    corrs = [corr for corr in corrs if corr in found_corrs or not shared_polyakov]
+    if shared_polyakov:
+        print("INFO: found data files of", ", ".join(corrs))
+    if len(corrs) == 0:
+        print("Didn't find any files! Are the input parameters correct?", args.conftype, args.qcdtype, flowtype, args.acc_sts)
+        exit()
+    all_files = [(stream_folder, corr, *files[corr]) for stream_folder, confs in streams for _, files in confs for corr in corrs if corr in files]
+    n_candidates = sum([len(confs) for _, confs in streams])
+
+    outputfolders = {corr: lpd.get_merged_data_path(args.qcdtype, corr, args.conftype, args.output_basepath) for corr in corrs}
+    container_paths = {corr: lpd.get_merged_container_path(args.qcdtype, corr, args.conftype, args.output_basepath) for corr in corrs}
+    manifest_paths = {corr: get_manifest_path(outputfolders[corr], args.conftype) for corr in corrs}
+    if shared_polyakov:
+        outputfolders["polyakov"] = lpd.get_merged_data_path(args.qcdtype, "polyakov", args.conftype, args.output_basepath)
+        container_paths["polyakov"] = lpd.get_merged_container_path(args.qcdtype, "polyakov", args.conftype, args.output_basepath)
+    lpd.create_folder(*outputfolders.values())
+
+    # in incremental mode, reuse everything that is listed in the manifests and did not change on disk
+    manifests = {corr: {} for corr in corrs}
+    old_data = {}
+    if args.incremental:
+        if all([os.path.isfile(manifest_paths[corr]) and os.path.isfile(container_paths[corr]) for corr in corrs]):
+            for corr in corrs:
+                old_attrs, old_data[corr] = lpd.load_merged_container(lpd.print_var("read", container_paths[corr]))
+                if old_attrs.get('row_selection') != row_selection:
+                    print("INFO: the selected flow times changed since the last merge, doing a full merge")
+                    manifests = {corr: {} for corr in corrs}
+                    break
+                manifests[corr] = read_manifest(lpd.print_var("read", manifest_paths[corr]))
+        else:
+            print("INFO: no manifest or merged data found, doing a full merge")
+    reused = {}
+    for stream_folder, corr, datafile, path in all_files:
+        if not archive:
+            stat = os.stat(path)
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+        old = manifests[corr].get((stream_folder, datafile))
+        if old is not None and old[1:3] == stats[path]:
+            reused[path] = old
+    # a conf is only reused if none of its files changed
+    reused_confs = set([(stream_folder, confnum) for stream_folder, confs in streams for confnum, files in confs
+                        if all([path in reused for _, path in files.values()])])
+    if args.incremental:
+        print("INFO: parsing", n_candidates - len(reused_confs), "new or changed confs, reusing", len(reused_confs), "confs")
+    # the reused confs keep their flow times, all new files have to match them
+    reference_flow_times = numpy.array(old_data[corrs[0]]['flow_times']) if len(reused_confs) > 0 else None
 
-    XX_numerator_real, XX_numerator_imag, polyakov_real, polyakov_imag, flow_times = ([] for _ in range(5))
+    # the data is written directly to new container files, which are created as soon as we know nflow, i.e. after the first valid conf.
+    # they replace the old ones only after the merge is complete.
+    merged = {}
+    container_attrs = {corr: dict(qcdtype=args.qcdtype, corr=corr, conftype=args.conftype, row_selection=row_selection) for corr in container_paths}
+    polyakov_key = "polyakov" if shared_polyakov else corrs[0]
+    flow_times = [] if reference_flow_times is None else reference_flow_times
     n_datafiles, n_streams = (0, 0)
     n_files_per_stream = []
     streamids = []
 
-    full_prefix = flow_prefix+XX_label
-    print("searching in subfolders of "+inputfolder + "   for  ", full_prefix+"*")
-
-    flowradii_ref = None
-    if args.reference_flowradii is not None:
-        flowradii_ref = numpy.loadtxt(args.reference_flowradii)
+    def create_merged_containers(nflow):
+        for key in container_paths:
+            if key == "polyakov":
+                observables = polyakov_observables
+            elif shared_polyakov:
+                observables = ("XX_real", "XX_imag")
+                container_attrs[key]['polyakov_container'] = os.path.relpath(container_paths["polyakov"], os.path.dirname(container_paths[key]))
+            else:
+                observables = merged_observables
+            merged[key], container_attrs[key] = create_merged_container(container_paths[key] + ".tmp", nflow, n_candidates, nt_half,
+                                                                        container_attrs[key], observables)
 
     # read in data from many files
-    shape = (0, 0)
-    folders = listdir(inputfolder)
-    folders = natsorted(folders)
+    shapes = {}
     corrupt_files = []
     conf_nums = []
-    for stream_folder in folders:
+    manifest_rows = {corr: [] for corr in corrs}
+    n_dropped = collections.Counter()  # confs whose file of this correlator is fine, but not the ones of all other correlators
+    paths_to_parse = [files[corr][1] for stream_folder, confs in streams for confnum, files in confs if (stream_folder, confnum) not in reused_confs
+                      for corr in corrs if corr in files]
+    if parsed_archive_members is not None:
+        parsed_files = (parsed_archive_members.pop(path) for path in paths_to_parse)
+    elif archive:
+        parsed_files = parse_archive_members(archive, paths_to_parse, args.nproc, row_filter)
+    else:
+        parsed_files = parse_datafiles(paths_to_parse, args.nproc, row_filter)
+    for stream_folder, confs in streams:
         n_files_this_stream = 0
-        if stream_folder.startswith(args.conftype+"_"):
-            print(stream_folder, end=', ')
-            datafiles = listdir(inputfolder+"/"+stream_folder)
-            datafiles = natsorted(datafiles)
-            for datafile in datafiles:
-                if datafile.startswith(full_prefix):
-                    path = inputfolder+"/"+stream_folder+"/"+datafile
-                    # print("reading "+datafile)
-                    confnum = int(lpd.remove_left_of_last('_U', path))
-                    if confnum >= args.min_conf_nr:
-                        tmp = numpy.loadtxt(path)
-                        if tmp.shape != (0,):
-                            # print(tmp.shape)
-                            if shape == (0, 0):
-                                shape = tmp.shape
-                            shape_wrong_but_all_flowtimes_exist = False
-                            if shape != tmp.shape:
-                                flow_times = tmp[:, 0]
-                                these_flowradii = numpy.sqrt(8 * flow_times) / nt
-                                if args.excess_workaround and tmp.shape != (0,) and tmp.shape[1] == shape[1] and tmp.shape[0] > shape[0]:
-                                    print("INFO: discarding", tmp.shape[0]-shape[0], " flow times from the end")
-                                    tmp = tmp[:shape[0]]
-                                elif args.reference_flowradii and are_all_floats_of_a_in_b(these_flowradii, flowradii_ref):
-                                    shape_wrong_but_all_flowtimes_exist = True
-                                    # TODO check that all flowradii in flowradii are also in the ref file.
-                                else:
-                                    print("error! shapes of input files don't match. ignoring this file.")
-                                    print(shape, " (previous) vs ", tmp.shape, " (current file)")
-                                    corrupt_files.append(datafile)
-                                    continue
-
-                            flow_times = tmp[:, 0]
-                            if args.reference_flowradii is not None or shape_wrong_but_all_flowtimes_exist:
-                                flowradii = numpy.sqrt(8*flow_times)/nt
-                                indices = get_flow_indices(flowradii, flowradii_ref)
-                                if len(indices) != len(flowradii_ref):
-                                    print("error! could not find all ref flowradii. skipping", datafile)
-                                    continue
-                            else:
-                                indices = numpy.asarray(range(0, len(flow_times)))
-
-                            flow_times = flow_times[indices]
-                            # print("nflow=", len(flow_times))
-                            polyakov_real.append(tmp[indices, 1])
-                            polyakov_imag.append(tmp[indices, 2])
-                            XX_numerator_real.append(tmp[indices, 3:int((3 + nt_half))] / multiplicity)
-                            XX_numerator_imag.append(tmp[indices, int((3 + nt_half)):] / multiplicity)
-                            conf_nums.append(confnum)
-                            n_datafiles += 1
-                            n_files_this_stream += 1
-            print("n_files_this_stream: ", n_files_this_stream)
-            if n_files_this_stream > 0:
-                n_files_per_stream.append(n_files_this_stream)
-                n_streams += 1
-                streamid = lpd.remove_left_of_last(r'_', stream_folder)
-                streamids.append(streamid)
+        print(stream_folder, end=', ')
+        for confnum, files in confs:
+
+            if (stream_folder, confnum) in reused_confs:
+                conf_ok = len(files) == len(corrs) and all([reused[path][5] == "ok" for _, path in files.values()])
+                for corr, (datafile, path) in files.items():
+                    _, _, _, nrows, ncols, status, row = reused[path]
+                    if status in ("ok", "skipped") and not conf_ok:
+                        status = "skipped"
+                        n_dropped[corr] += 1
+                    manifest_rows[corr].append((stream_folder, datafile, confnum, *stats[path], nrows, ncols, status))
+                    if status == "corrupt":
+                        corrupt_files.append(datafile)
+                if not conf_ok:
+                    continue
+                if len(merged) == 0:
+                    create_merged_containers(len(reference_flow_times))
+                for corr, (_, path) in files.items():
+                    row = reused[path][6]
+                    shapes.setdefault(corr, reused[path][3:5])
+                    for name in ("XX_real", "XX_imag"):
+                        merged[corr][name][:, n_datafiles] = old_data[corr][name][:, row]
+                row = reused[files[corrs[0]][1]][6]
+                for name in polyakov_observables:
+                    merged[polyakov_key][name][:, n_datafiles] = old_data[corrs[0]][name][:, row]
+                conf_nums.append(confnum)
+                n_datafiles += 1
+                n_files_this_stream += 1
+                continue
+
+            checked = {}
+            for corr in corrs:
+                if corr not in files:
+                    continue
+                datafile, path = files[corr]
+                tmp = next(parsed_files)
+                if tmp is None:
+                    print("error! could not parse", datafile, ". ignoring this file.")
+                    checked[corr] = ("corrupt", (0, 0), None, None)
+                elif tmp.shape == (0,):
+                    checked[corr] = ("empty", (0, 0), None, None)
+                else:
+                    shapes.setdefault(corr, tmp.shape)
+                    status, data, indices = check_datafile(tmp, datafile, shapes[corr], nt, args.excess_workaround, flowradii_ref)
+                    checked[corr] = (status, tmp.shape, data, indices)
+            conf_ok = len(checked) == len(corrs) and all([status == "ok" for status, _, _, _ in checked.values()])
+            if conf_ok:
+                if len(merged) == 0:
+                    create_merged_containers(len(checked[corrs[0]][3]))
+                for corr, (_, _, data, indices) in checked.items():
+                    if len(indices) != len(merged[corr]['flow_times']) or (reference_flow_times is not None
+                                                                           and not numpy.allclose(data[indices, 0], reference_flow_times)):
+                        print("ERROR: flow times of", files[corr][0], "do not match the existing merged data. do a full merge without --incremental.")
+                        exit(1)
+                    multiplicity = XX_labels[corr][1]
+                    merged[corr]['XX_real'][:, n_datafiles] = data[indices, 3:int((3 + nt_half))] / multiplicity
+                    merged[corr]['XX_imag'][:, n_datafiles] = data[indices, int((3 + nt_half)):] / multiplicity
+                _, _, data, indices = checked[corrs[0]]
+                if reference_flow_times is None:
+                    flow_times = data[indices, 0]
+                merged[polyakov_key]['polyakov_real'][:, n_datafiles] = data[indices, 1]
+                merged[polyakov_key]['polyakov_imag'][:, n_datafiles] = data[indices, 2]
+                conf_nums.append(confnum)
+                n_datafiles += 1
+                n_files_this_stream += 1
+            elif shared_polyakov:
+                print("INFO: not all correlators of conf", confnum, "in", stream_folder, "are fine, skipping this conf")
+            for corr, (status, parsed_shape, _, _) in checked.items():
+                if status == "corrupt":
+                    corrupt_files.append(files[corr][0])
+                elif status == "ok" and not conf_ok:
+                    status = "skipped"
+                    n_dropped[corr] += 1
+                manifest_rows[corr].append((stream_folder, files[corr][0], confnum, *stats[files[corr][1]], *parsed_shape, status))
+        print("n_files_this_stream: ", n_files_this_stream)
+        if n_files_this_stream > 0:
+            n_files_per_stream.append(n_files_this_stream)
+            n_streams += 1
+            streamid = lpd.remove_left_of_last(r'_', stream_folder)
+            streamids.append(streamid)
     if len(corrupt_files) > 0:
         print("\n============================= \nWARNING!!!!!!!!!!")
         print("These files are corrupt and were skipped:")
         for file in corrupt_files:
             print(file)
         print("================================\n")
+    for corr in corrs:
+        if n_dropped[corr] > 0:
+            print("WARN: dropped", n_dropped[corr], "confs of", corr, "whose files are fine, because the files of other correlators of these confs are not")
     if n_datafiles == 0:
         print("Didn't find any files! Are the input parameters correct?", args.conftype, beta, ns, nt, nt_half, args.qcdtype, fermions, temp, flowtype, args.corr, args.acc_sts)
         exit()
 
-    filename = outputfolder+'n_datafiles_'+args.conftype+'.dat'
-    print("write "+filename)
-    with open(filename, 'w') as outfile:
-        outfile.write('# number of datafiles (i.e. confs) for '+args.qcdtype+' '+args.conftype+'\n')
-        outfile.write(str(n_datafiles)+'\n')
-        outfile.write('# number of streams for '+args.qcdtype+' '+args.conftype+'\n')
-        outfile.write(str(n_streams)+'\n')
-        numpy.savetxt(outfile, numpy.asarray(n_files_per_stream), header='number of confs contained in each stream respectively', fmt='%i')
-        outfile.write('# confnums, ordered by stream\n')
-        numpy.savetxt(outfile, numpy.asarray(conf_nums), fmt='%i')
-    numpy.savetxt(outputfolder+'flowtimes_'+args.conftype+'.dat', flow_times, header=r'flow times \tau_F for '+args.qcdtype+' '+args.conftype)
-
-    # these have the following shape (nconf, nflow, Ntau/2)
-    numpy.save(lpd.print_var("write", outputfolder + args.corr + '_real_' + args.conftype + '_merged.npy'), XX_numerator_real)
-    numpy.save(lpd.print_var("write", outputfolder + args.corr + '_imag_' + args.conftype + '_merged.npy'), XX_numerator_imag)
-    numpy.save(lpd.print_var("write", outputfolder+'polyakov_real_'+args.conftype+'_merged.npy'), polyakov_real)
-    numpy.save(lpd.print_var("write", outputfolder+'polyakov_imag_'+args.conftype+'_merged.npy'), polyakov_imag)
+    for corr in corrs:
+        filename = outputfolders[corr]+'n_datafiles_'+args.conftype+'.dat'
+        print("write "+filename)
+        with open(filename, 'w') as outfile:
+            outfile.write('# number of datafiles (i.e. confs) for '+args.qcdtype+' '+args.conftype+'\n')
+            outfile.write(str(n_datafiles)+'\n')
+            outfile.write('# number of streams for '+args.qcdtype+' '+args.conftype+'\n')
+            outfile.write(str(n_streams)+'\n')
+            numpy.savetxt(outfile, numpy.asarray(n_files_per_stream), header='number of confs contained in each stream respectively', fmt='%i')
+            outfile.write('# confnums, ordered by stream\n')
+            numpy.savetxt(outfile, numpy.asarray(conf_nums), fmt='%i')
+        numpy.savetxt(outputfolders[corr]+'flowtimes_'+args.conftype+'.dat', flow_times, header=r'flow times \tau_F for '+args.qcdtype+' '+args.conftype)
+        write_manifest(manifest_paths[corr], args.qcdtype, args.conftype, manifest_rows[corr])
+
+    for key in merged:
+        merged[key]['flow_times'][:] = flow_times
+        merged[key]['conf_nums'][:n_datafiles] = conf_nums
+        for array in merged[key].values():
+            if isinstance(array, numpy.memmap):
+                array.flush()
+    merged, old_data = None, None  # release the memory maps before the files are replaced
+    for key in container_paths:
+        container_attrs[key].update(nconf=n_datafiles, n_streams=n_streams, n_files_per_stream=n_files_per_stream, streamids=streamids)
+        lpd.update_container_attrs(container_paths[key] + ".tmp", container_attrs[key])
+        os.replace(container_paths[key] + ".tmp", lpd.print_var("write", container_paths[key]))
 
     print("done with "+args.qcdtype+" "+args.conftype)
 
@@ -2,47 +2,68 @@
 
 import lib_process_data as lpd
 import numpy
+import os
+import io
+import contextlib
 from latqcdtools.statistics import statistics as stat
-from latqcdtools.statistics import bootstr
 import matplotlib
 
 
-def myapp_verbose(vec, val):
-    print(val, end=", ")
-    vec.append(val)
-
-
-def resample_and_save_data(reduce_function, XX_data, n_samples, n_datafiles, file_prefix, flow_times, qcdtype, conftype, corr, nt, BB_renorm, nproc, conf_axis):
-    XX_samples, XX, XX_err = bootstr.bootstr(reduce_function, XX_data, numb_samples=n_samples, sample_size=n_datafiles, conf_axis=conf_axis, return_sample=True, same_rand_for_obs=True, parallelize=True, nproc=nproc, seed=0, err_by_dist=True)
-    XX_samples = numpy.asarray(XX_samples)
-    # XX:     this is the bootstrap estimate for the mean of the correlator
-    # XX_err: this is the bootstrap estimate for the error of the mean of the correlator
-
-    # save samples
-    numpy.save(lpd.print_var("write", file_prefix + "_" + conftype + "_samples.npy"), XX_samples)
-
-    # write XX and XX_err to file
-    with open(lpd.print_var("write", file_prefix+"_"+conftype+".dat"), 'w') as outfile:
-        outfile.write('# bootstrap mean of '+str(n_datafiles)+' measurements of '+corr+' correlator for '+qcdtype+' '+conftype+'\n')
-        outfile.write('# rows correspond to flow times, columns to dt = {1, ... , Ntau/2}\n')
-        lpd.write_flow_times(outfile, flow_times)
-        numpy.savetxt(outfile, XX)
-    with open(lpd.print_var("write", file_prefix+"_err_"+conftype+".dat"), 'w') as outfile:
-        outfile.write('# bootstrap mean err of '+str(n_datafiles)+' measurements of '+corr+' correlator '+qcdtype+' '+conftype+'\n')
-        outfile.write('# rows correspond to flow times, columns to dt = {1, ... , Ntau/2}\n')
-        lpd.write_flow_times(outfile, flow_times)
-        numpy.savetxt(outfile, XX_err)
-
-    # for each tau, compute flow correlation matrix.
-    XX_samples = numpy.swapaxes(XX_samples, 0, 2)  # change data structure such that numpy.cov understands it
-    pcov = []
-    for i in range(int(nt/2)):
-        pcov.append(numpy.corrcoef(XX_samples[i]))
-    pcov = numpy.asarray(pcov)
-    numpy.save(lpd.print_var("write", file_prefix + "_flow_cov_" + conftype + ".npy"), pcov)
-
-
-def load_merged_data(qcdtype, corr, conftype, basepath, n_discard_per_stream=None, only_metadata=False):
+def resample_and_save_data(XX_data, n_samples, n_datafiles, file_prefix, flow_times, qcdtype, conftype, corr, nt, BB_renorm, flow_cov_band=None):
+    """ bootstrap the correlator(s) in XX_data of shape (nconf, nflow, Ntau/2+1) = (numerator, polyakov loop). corr and file_prefix can also be lists
+    of several correlators, whose numerators are then stacked along the last axis of XX_data in front of the polyakov loop. all of them are resampled
+    with the same bootstrap samples, such that their sample files are aligned. if flow_cov_band is given, the flow covariance is only kept for flow
+    times that are at most flow_cov_band indices apart. """
+    # the bootstrap of compute_XX_corr (a ratio of means) is done by lpd.iter_bootstrap_mean_ratio, which computes the means of many samples at once
+    # as a matrix product. the draws of each sample come from lpd.get_rng, keyed by qcdtype and conftype, so they are the same for all corrs of an
+    # ensemble (if they are binned the same way) and do not depend on how the samples are split into blocks.
+    # the samples are written block by block to a memory-mapped npy file, and the flow covariance matrix is accumulated on the way, so the memory
+    # does not grow with n_samples.
+    corrs = [corr] if isinstance(corr, str) else corr
+    file_prefixes = [file_prefix] if isinstance(file_prefix, str) else file_prefix
+    nt_half = int(nt/2)
+    numerator, denominator = numpy.split(XX_data, [nt_half * len(corrs), ], axis=2)
+    n_flow = numerator.shape[1]
+    all_XX_samples = [numpy.lib.format.open_memmap(lpd.print_var("write", thisprefix + "_" + conftype + "_samples.npy"), mode='w+', dtype=float,
+                                                   shape=(n_samples, n_flow, nt_half)) for thisprefix in file_prefixes]
+    flow_covariances = [lpd.CovarianceAccumulator(flow_cov_band) for _ in corrs]
+    for start, samples in lpd.iter_bootstrap_mean_ratio(numerator, denominator, n_samples, qcdtype + "/" + conftype, sample_size=n_datafiles):
+        for c, (XX_samples, flow_covariance) in enumerate(zip(all_XX_samples, flow_covariances)):
+            XX_samples[start:start+len(samples)] = samples[..., c*nt_half:(c+1)*nt_half]
+            flow_covariance.add(numpy.swapaxes(samples[..., c*nt_half:(c+1)*nt_half], 1, 2))  # for each tau, the flow times are the variables
+
+    for thiscorr, thisprefix, XX_samples, flow_covariance in zip(corrs, file_prefixes, all_XX_samples, flow_covariances):
+        XX_samples.flush()
+
+        # XX:     this is the bootstrap estimate for the mean of the correlator
+        # XX_err: this is the bootstrap estimate for the error of the mean of the correlator
+        # they are computed from the samples file, a few flow times at a time.
+        XX = numpy.empty((n_flow, nt_half))
+        XX_err = numpy.empty((n_flow, nt_half))
+        flow_chunk = max(1, int(2**24 / (n_samples * nt_half)))
+        for i in range(0, n_flow, flow_chunk):
+            samples = numpy.asarray(XX_samples[:, i:i+flow_chunk])
+            XX[i:i+flow_chunk] = numpy.median(samples, axis=0)
+            XX_err[i:i+flow_chunk] = lpd.dev_by_dist(samples, axis=0)
+
+        # write XX and XX_err to file
+        with open(lpd.print_var("write", thisprefix+"_"+conftype+".dat"), 'w') as outfile:
+            outfile.write('# bootstrap mean of '+str(n_datafiles)+' measurements of '+thiscorr+' correlator for '+qcdtype+' '+conftype+'\n')
+            outfile.write('# rows correspond to flow times, columns to dt = {1, ... , Ntau/2}\n')
+            lpd.write_flow_times(outfile, flow_times)
+            numpy.savetxt(outfile, XX)
+        with open(lpd.print_var("write", thisprefix+"_err_"+conftype+".dat"), 'w') as outfile:
+            outfile.write('# bootstrap mean err of '+str(n_datafiles)+' measurements of '+thiscorr+' correlator '+qcdtype+' '+conftype+'\n')
+            outfile.write('# rows correspond to flow times, columns to dt = {1, ... , Ntau/2}\n')
+            lpd.write_flow_times(outfile, flow_times)
+            numpy.savetxt(outfile, XX_err)
+
+        # for each tau, the flow covariance and correlation matrix (load with lpd.load_flow_covariance)
+        lpd.save_flow_covariance(lpd.print_var("write", thisprefix + "_flow_cov_" + conftype + ".npz"), flow_covariance)
+    del all_XX_samples
+
+
+def load_merged_data(qcdtype, corr, conftype, basepath, n_discard_per_stream=None, only_metadata=False, flow_indices=None):
     """
     load and reorganize data
 
@@ -50,20 +71,35 @@ def load_merged_data(qcdtype, corr, conftype, basepath, n_discard_per_stream=Non
     XX_numerator_real and polyakov_real: first index = different measurements, second index = flowtime, third index = tauT
     XX_data: first index [0]=XX_numerator_real, [1]=polyakov_real, second index = different measurements (-> pairs of the form (XX_numerator_real[x], XX_polyakov_real[x]))
     the bootstrap leaves out pairs of (XX_numerator, Polyakov), this is done by the last argument (1), which specifies the axis on which the data pairs lie.
+
+    if flow_indices is given, only these flow times are read from the merged data container.
+    merged data from before the container format (four separate *_merged.npy files) can still be read.
     """
 
     inputfolder = lpd.get_merged_data_path(qcdtype, corr, conftype, basepath)
-
-    flow_times = numpy.loadtxt(lpd.print_var("read", inputfolder+"flowtimes_"+conftype+".dat"))
+    container_path = lpd.get_merged_container_path(qcdtype, corr, conftype, basepath)
+
+    if os.path.isfile(container_path):
+        attrs, merged = lpd.load_merged_container(lpd.print_var("read", container_path))
+        flow_times = numpy.asarray(merged['flow_times'])
+        n_datafiles, n_streams = attrs['nconf'], attrs['n_streams']
+        n_files_per_stream = attrs['n_files_per_stream']
+        tmp = [int(i) for i in merged['conf_nums']]
+    else:
+        merged = None
+        flow_times = numpy.loadtxt(lpd.print_var("read", inputfolder+"flowtimes_"+conftype+".dat"))
+        metadata = numpy.loadtxt(lpd.print_var("read", inputfolder + "n_datafiles_" + conftype + ".dat"))
+        n_datafiles, n_streams = [int(i) for i in metadata[0:2]]
+        n_files_per_stream = [int(i) for i in metadata[2:2+n_streams]]
+        tmp = [int(i) for i in metadata[2+n_streams:]]
+    if flow_indices is None:
+        flow_indices = slice(None)
+    flow_times = flow_times[flow_indices]
     n_flow = len(flow_times)
 
-    metadata = numpy.loadtxt(lpd.print_var("read", inputfolder + "n_datafiles_" + conftype + ".dat"))
-    n_datafiles, n_streams = [int(i) for i in metadata[0:2]]
     if n_discard_per_stream is None:
         n_discard_per_stream = [0 for _ in range(n_streams)]
 
-    n_files_per_stream = [int(i) for i in metadata[2:2+n_streams]]
-    tmp = [int(i) for i in metadata[2+n_streams:]]
     confnums = []
     offset = 0
     for i in range(n_streams):
@@ -75,9 +111,6 @@ def load_merged_data(qcdtype, corr, conftype, basepath, n_discard_per_stream=Non
         exit(1)
 
     if not only_metadata:
-        XX_numerator_real_tmp = numpy.load(lpd.print_var("read", inputfolder+corr+"_real_"+conftype+"_merged.npy"))
-        polyakov_real_tmp = numpy.load(lpd.print_var("read", inputfolder + "polyakov_real_" + conftype + "_merged.npy"))
-
         # discard data that is not thermalized
         slices = []
         counter_up = 0
@@ -88,8 +121,15 @@ def load_merged_data(qcdtype, corr, conftype, basepath, n_discard_per_stream=Non
             counter_up += n_files_per_stream[i]
             slices.append(slice(counter_dn, counter_up))
 
-        XX_numerator_real = numpy.concatenate([XX_numerator_real_tmp[thisslice] for thisslice in slices])
-        polyakov_real = numpy.expand_dims(numpy.concatenate([polyakov_real_tmp[thisslice] for thisslice in slices]), axis=2)
+        if merged is not None:
+            # the container is flow-time-major, so we only read the requested flow times of each stream and then move the conf axis to the front
+            XX_numerator_real = numpy.moveaxis(numpy.concatenate([merged['XX_real'][flow_indices, thisslice] for thisslice in slices], axis=1), 1, 0)
+            polyakov_real = numpy.expand_dims(numpy.concatenate([merged['polyakov_real'][flow_indices, thisslice] for thisslice in slices], axis=1).T, axis=2)
+        else:
+            XX_numerator_real_tmp = numpy.load(lpd.print_var("read", inputfolder+corr+"_real_"+conftype+"_merged.npy"), mmap_mode='r')
+            polyakov_real_tmp = numpy.load(lpd.print_var("read", inputfolder + "polyakov_real_" + conftype + "_merged.npy"), mmap_mode='r')
+            XX_numerator_real = numpy.concatenate([XX_numerator_real_tmp[thisslice, flow_indices] for thisslice in slices])
+            polyakov_real = numpy.expand_dims(numpy.concatenate([polyakov_real_tmp[thisslice, flow_indices] for thisslice in slices]), axis=2)
         XX_data = (XX_numerator_real, polyakov_real)
     else:
         XX_data = None
@@ -97,105 +137,87 @@ def load_merged_data(qcdtype, corr, conftype, basepath, n_discard_per_stream=Non
     return flow_times, n_flow, n_datafiles, n_streams, n_files_per_stream, XX_data, confnums
 
 
-def get_equally_spaced_timeseries(x, y, MC_stepsize):
-
-    def errormessage(this_nconfs_missing, x1, x2):
-        print("ERROR: missing", this_nconfs_missing, "confs between", x1, "and", x2)
-
-    # clean data such that trajectory spacing is constant=args.MC_stepsize.
-    # 1. filter out confnums that are not divisible by *half* the MC stepsize
-    # 2. average pairs of confs spaced out by only by *half* the stepsize to get one conf with spacing one full MC_stepsize.
-    # 3. whenever there is one conf missing, simply insert the average between the previous and next conf instead.
-    # (this should only happen very rarely, for example when some data file was corrupted).
-    half_MC_stepsize = int(MC_stepsize / 2)
-
-    mask = numpy.asarray(numpy.mod(x, int(half_MC_stepsize)), dtype=bool)
-    x = x[~mask]
-    y = y[~mask]
-
-    y_bin = []
-    x_bin = []
-    i = 0
-    while i < len(x) - 1:
-        diff = x[i + 1] - x[i]
-        xi_is_multiple_of_stepsize = numpy.mod(x[i], MC_stepsize) == 0
-        diff_is_multiple_of_stepsize = numpy.mod(diff, MC_stepsize) == 0
-
-        y_interpolated = (y[i + 1] + y[i]) / 2
-
-        if xi_is_multiple_of_stepsize and diff == MC_stepsize:  # this is the default case where nothing special happens.
-            x_bin.append(x[i])
-            y_bin.append(y[i])
-        elif xi_is_multiple_of_stepsize and diff == half_MC_stepsize:  # in this case we do an extra increase of i and thus skip the half step.
-            y_bin.append(y[i])
-            x_bin.append(x[i])
-            if i < len(x) - 2 and x[i + 2] - x[i + 1] == MC_stepsize:  # this fixes a case like this: 1000 1005 1015 1020 --> 1000 1010 1020
-                print("WARNe: ", end="")
-                myapp_verbose(x_bin, x[i + 1] + half_MC_stepsize)
-                y_bin.append((y[i + 2]+y[i + 1])/2)
-                i += 1
-            i += 1  # this skips the half MC step
-        elif diff > MC_stepsize and xi_is_multiple_of_stepsize and diff_is_multiple_of_stepsize:
-            x_bin.append(x[i])
-            y_bin.append(y[i])
-            print(x[i], ": WARNa diff=", diff, end=", ", sep="")
-            nconfs_missing = int(diff / MC_stepsize) - 1
-            if nconfs_missing < 3:
-                for j in range(1, nconfs_missing + 1):
-                    myapp_verbose(x_bin, x[i] + j * MC_stepsize)
-                    y_bin.append(y_interpolated)
-            else:
-                errormessage(nconfs_missing, x[i], x[i+1])
-        elif diff > MC_stepsize and not xi_is_multiple_of_stepsize and diff_is_multiple_of_stepsize:
-            print(x[i], ": WARNb: diff=", diff, end=", ", sep="")
-            nconfs_missing = int(diff / MC_stepsize)
-            if nconfs_missing < 3:
-                for j in range(1, nconfs_missing + 1):
-                    myapp_verbose(x_bin, x[i] + half_MC_stepsize + (j - 1) * MC_stepsize)
-                    y_bin.append(y_interpolated)
-            else:
-                errormessage(nconfs_missing, x[i], x[i+1])
-        elif diff > MC_stepsize and not xi_is_multiple_of_stepsize and not diff_is_multiple_of_stepsize:
-            print(x[i], ": WARNc: diff=", diff, end=", ", sep="")
-            nconfs_missing = diff // MC_stepsize
-            if nconfs_missing < 3:
-                for j in range(1, nconfs_missing + 1):
-                    myapp_verbose(x_bin, x[i] + half_MC_stepsize + (j - 1) * MC_stepsize)
-                    y_bin.append(y_interpolated)
-            else:
-                errormessage(nconfs_missing, x[i], x[i+1])
-        elif diff > MC_stepsize and xi_is_multiple_of_stepsize and not diff_is_multiple_of_stepsize:
-            print(x[i], ": WARNd: diff=", diff, end=", ", sep="")
-            nconfs_missing = diff // MC_stepsize
-            myapp_verbose(x_bin, x[i])
-            y_bin.append(y[i])
-            if nconfs_missing < 3:
-                for j in range(1, nconfs_missing + 1):
-                    myapp_verbose(x_bin, x[i] + j * MC_stepsize)
-                    y_bin.append(y_interpolated)
-            else:
-                errormessage(nconfs_missing, x[i], x[i+1])
-        elif i > 0 and (x[i] - x_bin[-1]) > MC_stepsize:
-            print("WARN: There is a large gap in the time series! x[i]=", x[i], ", x_bin[i-1]=", x_bin[-1], sep="")
-        else:
-            print("ignore ", x[i], sep="", end=", ")
+def load_joint_merged_data(qcdtype, corrs, conftype, basepath):
+    """ load the merged data of one or more correlators of an ensemble (see load_merged_data) for a joint reduction. returns the same as
+    load_merged_data, except that the data has the shape (nconf, nflow, len(corrs)*Ntau/2+1): the numerators of all corrs, followed by the polyakov
+    loop. all corrs need to have the same confs and flow times, which is the case if they were merged together (_1_merge_data.py --corr all). """
+    all_numerators = []
+    for corr in corrs:
+        flow_times, n_flow, n_datafiles, n_streams, n_files_per_stream, XX_data, confnums = load_merged_data(qcdtype, corr, conftype, basepath, None)
+        if all_numerators and (not numpy.array_equal(flow_times, reference[0]) or confnums != reference[1]):
+            print("ERROR: the merged data of", corr, "does not have the same flow times and confs as that of", corrs[0], "for", conftype,
+                  "\n       merge them together with _1_merge_data.py --corr all")
+            exit(1)
+        reference = (flow_times, confnums)
+        all_numerators.append(XX_data[0])
+    data = numpy.concatenate((*all_numerators, XX_data[1]), axis=2)
+    return flow_times, n_flow, n_datafiles, n_streams, n_files_per_stream, data, confnums
+
+
+def find_merged_corrs(qcdtype, conftype, basepath):
+    """ all corrs for which there is merged data of this conftype """
+    corrs = []
+    for corr in ["EE", "BB", "EE_clover", "BB_clover"]:
+        if os.path.isfile(lpd.get_merged_container_path(qcdtype, corr, conftype, basepath)) or \
+                os.path.isfile(lpd.get_merged_data_path(qcdtype, corr, conftype, basepath) + "n_datafiles_" + conftype + ".dat"):
+            corrs.append(corr)
+    if not corrs:
+        print("ERROR: no merged data found for", qcdtype, conftype, "in", basepath)
+        exit(1)
+    return corrs
 
-        i += 1
 
-    # don't forget the last entry
-    if x[-1] - x_bin[-1] == MC_stepsize:
-        y_bin.append(y[-1])
-        x_bin.append(x[-1])
-    print("")
+def get_equally_spaced_timeseries(x, y, MC_stepsize, max_nconfs_missing=2):
+    """ clean data such that the trajectory spacing is constant=MC_stepsize.
+    the new time series lives on the multiples of MC_stepsize between the first and last conf. at each of these, the conf itself is used if it
+    exists. otherwise the average of the previous and next conf is inserted (also confs that are not on the grid, e.g. those shifted by half the
+    MC_stepsize), as long as there are at most max_nconfs_missing grid points in a row without a conf (this should only happen very rarely, for
+    example when some data file was corrupted). confs that are not on the grid are skipped, and confs that are not divisible by half the
+    MC_stepsize are ignored entirely.
+    returns x and y of the new time series and a summary dict with the conf numbers that were inserted, skipped, or are missing (longer gaps). """
 
-    if x_bin[-1] - x_bin[0] != (len(x_bin) - 1) * MC_stepsize:
+    half_MC_stepsize = int(MC_stepsize / 2)
+    mask = numpy.mod(x, half_MC_stepsize) == 0
+    summary = dict(ignored=x[~mask])
+    x = x[mask]
+    y = y[mask]
+
+    grid = numpy.arange(-(-x[0] // MC_stepsize) * MC_stepsize, x[-1] // MC_stepsize * MC_stepsize + 1, MC_stepsize)
+    indices = numpy.searchsorted(x, grid)
+    exists = x[numpy.fmin(indices, len(x) - 1)] == grid
+
+    # grid points without conf that lie between the same two confs form a gap. insert the average of these two confs if the gap is small enough.
+    previous = indices[~exists] - 1
+    gap_sizes = numpy.bincount(previous, minlength=len(x))[previous]
+    insert = gap_sizes <= max_nconfs_missing
+    summary["inserted"] = grid[~exists][insert]
+    summary["missing"] = grid[~exists][~insert]
+    summary["skipped"] = numpy.setdiff1d(x, grid)
+
+    x_bin = grid[exists]
+    x_bin = numpy.sort(numpy.concatenate((x_bin, summary["inserted"])))
+    y_bin = numpy.empty((len(x_bin), *y.shape[1:]), dtype=y.dtype)
+    inserted = numpy.isin(x_bin, summary["inserted"])
+    y_bin[~inserted] = y[indices[exists]]
+    y_bin[inserted] = (y[previous[insert]] + y[previous[insert] + 1]) / 2
+
+    if len(summary["missing"]) > 0 or x_bin[-1] - x_bin[0] != (len(x_bin) - 1) * MC_stepsize:
         print("ERROR: MC time stepsize is NOT constant=", MC_stepsize, sep="")
         print("x_bin[-1]-x_bin[0]=", x_bin[-1] - x_bin[0], " but (len(x_bin)-1)*MC_stepsize=", (len(x_bin) - 1) * MC_stepsize, sep="")
 
-    return numpy.asarray(x_bin), numpy.asarray(y_bin)
+    return x_bin, y_bin, summary
+
 
+def print_timeseries_summary(summary):
+    for key, text in (("inserted", "WARN: inserted the average of the neighbouring confs at"),
+                      ("missing", "ERROR: too many confs missing in a row, left out"),
+                      ("skipped", "INFO: skipped confs that are not on the grid:"),
+                      ("ignored", "INFO: ignored confs that are not divisible by half the MC stepsize:")):
+        if len(summary[key]) > 0:
+            print(text, len(summary[key]), "confs:", *summary[key])
 
-def find_reliable_tauint(index_max, index_start, y, tpickmax_increment):
+
+def find_reliable_tauint(index_max, index_start, y, tpickmax_increment, acoutfileName=None):
     nconf = index_max - index_start
     diff = 0
     tpickmax = 2
@@ -203,7 +225,7 @@ def find_reliable_tauint(index_max, index_start, y, tpickmax_increment):
 
     # first run, such that we always get a tau_int, even when nblocks is <3 on the first iteration.
     nblocks = int(nconf / tpickmax)
-    tau_int, tau_inte, tau_intbias, itpick = stat.getTauInt(y[index_start:], nblocks, tpickmax, acoutfileName='acor.d', showPlot=False)
+    tau_int, tau_inte, tau_intbias, itpick = stat.getTauInt(y[index_start:], nblocks, tpickmax, acoutfileName=acoutfileName, showPlot=False)
 
     while diff < 1:
         nblocks = int(nconf / tpickmax)
@@ -211,7 +233,7 @@ def find_reliable_tauint(index_max, index_start, y, tpickmax_increment):
             too_small = True
             break
 
-        tau_int, tau_inte, tau_intbias, itpick = stat.getTauInt(y[index_start:], nblocks, tpickmax, acoutfileName='acor.d', showPlot=False)
+        tau_int, tau_inte, tau_intbias, itpick = stat.getTauInt(y[index_start:], nblocks, tpickmax, acoutfileName=acoutfileName, showPlot=False)
 
         diff = tpickmax - itpick
         tpickmax += tpickmax_increment
@@ -219,49 +241,76 @@ def find_reliable_tauint(index_max, index_start, y, tpickmax_increment):
     return tau_int, tau_inte, tau_intbias, itpick, too_small, nconf
 
 
-def get_optimized_start_and_tauint(x, y, index_offset, MC_stepsize, streamid, blocksize, tpickmax_increment, include_bias):
+def estimate_tauint(args, y, index_start, index_max, flowidx, dataindex, acoutfileName=None):
+    """ estimate tau_int of the stream y[index_start:] of shape (nconf, nflow, Ntau/2+1).
+    with --tauint_method jackknife only the polyakov loop at flowidx is used (see find_reliable_tauint, which writes the autocorrelation function to
+    acoutfileName if given). with fft, tau_int of all observables is
+    computed at once (see lpd.get_tauint_fft) and the returned one is the polyakov loop at flowidx or the maximum, depending on --binlength_from.
+    returns tau_int, tau_inte, tau_intbias, itpick, too_small, nconf and, for fft, tau_int and tau_inte of all observables. """
+    if args.tauint_method == "jackknife":
+        return (*find_reliable_tauint(index_max, index_start, y[:, flowidx, dataindex], args.tpickmax_increment, acoutfileName), None)
+    nconf = index_max - index_start
+    tau_int, tau_inte, tau_intbias, window = lpd.get_tauint_fft(y[index_start:])
+    if args.binlength_from == "max":
+        idx = numpy.unravel_index(numpy.argmax(tau_int), tau_int.shape)
+    else:
+        idx = (flowidx, dataindex)
+    too_small = window[idx] >= len(y) - index_start - 1
+    return tau_int[idx], tau_inte[idx], tau_intbias[idx], int(window[idx]), too_small, nconf, numpy.stack((tau_int, tau_inte))
+
+
+def get_optimized_start_and_tauint(args, x, y, index_offset, streamid, flowidx, dataindex, acoutfileName=None):
+    """ find the start index (in steps of --blocksize) that maximizes the effective number of configurations nconf/tau_int of the polyakov loop.
+    with --tauint_method fft, all candidate starts are scored at once by lpd.get_tauint_vs_start. returns best_start_index, tau_int, tau_inte,
+    tau_intbias, itpick and all_tauint at the best start (see estimate_tauint), and the curve nconf_eff(start) as a tuple (starts, nconf_eff). """
+    MC_stepsize, blocksize, include_bias = args.MC_stepsize, args.blocksize, args.include_bias
     index_max = len(x)
-    best_start_index = index_offset
-    best_nconfeff = 0
-    bestvals = [0, 0, 0, 0]
-    for index_start in range(index_offset, index_max - blocksize, blocksize):
-        tau_int, tau_inte, tau_intbias, itpick, too_small, nconf = find_reliable_tauint(index_max, index_start, y, tpickmax_increment)
-
-        # maximize this quantity
-        if include_bias:
-            # this can somewhat reliably find the point where the time series is stationary (ie, fluctuates around a fixed value).
-            # don't use if you know that your time series is already stationary, as the tau_intbias estimate is a bit unreliable.
-            nconf_eff = nconf / (tau_int + tau_intbias)
-        else:
-            nconf_eff = nconf / tau_int
+    starts = numpy.arange(index_offset, max(index_offset + 1, index_max - blocksize), blocksize)
+    if args.tauint_method == "fft":
+        tau_int, _, tau_intbias, _ = lpd.get_tauint_vs_start(y[:, flowidx, dataindex], starts)
+    else:
+        estimates = [find_reliable_tauint(index_max, index_start, y[:, flowidx, dataindex], args.tpickmax_increment, acoutfileName)
+                     for index_start in starts]
+        tau_int = numpy.asarray([estimate[0] for estimate in estimates])
+        tau_intbias = numpy.asarray([estimate[2] for estimate in estimates])
+
+    # maximize this quantity
+    nconf = index_max - starts
+    if include_bias:
+        # this can somewhat reliably find the point where the time series is stationary (ie, fluctuates around a fixed value).
+        # don't use if you know that your time series is already stationary, as the tau_intbias estimate is a bit unreliable.
+        nconf_eff = nconf / (tau_int + tau_intbias)
+    else:
+        nconf_eff = nconf / tau_int
+    best_start_index = starts[numpy.argmax(nconf_eff)]
 
-        if nconf_eff > best_nconfeff:
-            best_nconfeff = nconf_eff
-            best_start_index = index_start
-            bestvals = [tau_int, tau_inte, tau_intbias, itpick]
-            best_too_small = too_small
+    if args.tauint_method == "fft":
+        tau_int, tau_inte, tau_intbias, itpick, too_small, _, all_tauint = estimate_tauint(args, y, best_start_index, index_max, flowidx, dataindex)
+    else:
+        tau_int, tau_inte, tau_intbias, itpick, too_small, _ = estimates[numpy.argmax(nconf_eff)]
+        all_tauint = None
 
     print_result(streamid, x, best_start_index, MC_stepsize, tau_int, tau_inte, tau_intbias, itpick, index_max)
 
-    if best_too_small:
+    if too_small:
         print_too_small_warning()
     else:
         print("")
 
-    return [best_start_index, *bestvals]
+    return [best_start_index, tau_int, tau_inte, tau_intbias, itpick, all_tauint, (starts, nconf_eff)]
 
 
 def print_result(streamid, x, best_start_index, MC_stepsize, tau_int, tau_inte, tau_intbias, itpick, index_max):
     print("stream=", streamid, ", nconf=[", int(x[best_start_index] / MC_stepsize), ",", int(x[-1] / MC_stepsize), "]", " ---> tau_int=",
           r'{0:.1f}'.format(tau_int), "+-", r'{0:.0f}'.format(tau_inte),
-          " (+", r'{0:.0f}'.format(tau_intbias), ") at n=", itpick, ", nconfeff=", int((index_max - best_start_index) / int(tau_int)), sep="", end="")
+          " (+", r'{0:.0f}'.format(tau_intbias), ") at n=", itpick, ", nconfeff=", int((index_max - best_start_index) / max(1, int(tau_int))), sep="", end="")
 
 
 def print_too_small_warning():
     print(", WARN: data set too small to find a decrease of tau_int inside the largest possible jackknife block. very small number of blocks (2).")
 
 
-def plot_MC_time(x, y, flowidx, dataindex, results, args, flowtime, nt, ns, beta):
+def plot_MC_time(x, y, results, args, flowtime, nt, ns, beta, nconf_eff_curves=None):
     results = numpy.asarray(results)
     n_streams = results.shape[0]
 
@@ -272,7 +321,7 @@ def plot_MC_time(x, y, flowidx, dataindex, results, args, flowtime, nt, ns, beta
     for k in range(n_streams):
 
         thisx = x[k]
-        thisy = y[k][:, flowidx, dataindex]
+        thisy = y[k]
 
         best_start = int(results[k][0])
         bestvals = results[k][1:]
@@ -299,15 +348,31 @@ def plot_MC_time(x, y, flowidx, dataindex, results, args, flowtime, nt, ns, beta
     diff = thisylims[1] - thisylims[0]
     ax.set_ylim(numpy.fmax(0, thisylims[0] - diff / 4), numpy.fmin(0.5, thisylims[1] + diff / 4))
 
-    outputfolder = lpd.get_plot_path(args.qcdtype, args.corr, args.conftype, args.basepath_plot) if not args.outputpath else args.outputpath
+    # the polyakov loop is the same for all corrs
+    plotcorr = args.corr if args.corr != "all" else "polyakov"
+    outputfolder = lpd.get_plot_path(args.qcdtype, plotcorr, args.conftype, args.basepath_plot) if not args.outputpath else args.outputpath
     lpd.create_folder(outputfolder)
     fig.savefig(outputfolder + "/" + "polyakovloop_MCtime" + args.suffix + ".pdf")
     matplotlib.pyplot.close(fig)
 
+    # effective number of configurations as a function of the thermalization cut (only with --blocksize)
+    if nconf_eff_curves is not None and any(curve is not None for curve in nconf_eff_curves):
+        fig, ax, _ = lpd.create_figure(xlabel=r'start ' + xlabel, ylabel=r'$n_\mathrm{conf}/\tau_\mathrm{int}$', figsize="fullwidth_slim")
+        for k, curve in enumerate(nconf_eff_curves):
+            if curve is not None and k in args.show_id:
+                starts, nconf_eff = curve
+                best_start = int(results[k][0])
+                ref = ax.errorbar(x[k][starts] / args.MC_stepsize, nconf_eff, fmt='-', lw=0.5, label=str(k+1))
+                ax.axvline(x=x[k][best_start] / args.MC_stepsize, color=ref.lines[0].get_color(), lw=0.5, alpha=0.5)
+        ax.legend(**legendoptions, title=r'stream')
+        fig.savefig(outputfolder + "/" + "nconfeff_vs_start" + args.suffix + ".pdf")
+        matplotlib.pyplot.close(fig)
+
 
 def compute_XX_corr(data):
     """
     function for bootstrap routine that computes an XX correlator (with XX=EE or BB) normalized by the polyakov loop. numerator data (i.e. --X--X--) is first index, polyakov loop is second index of data.
+    resample_and_save_data computes the same with lpd.bootstrap_mean_ratio, this is the reference for other bootstrap routines.
     """
     # TODO the way this is written FORCES same_rand_for_obs=true. maybe we dont want this.
     nt = data.shape[-1] - 1
@@ -320,27 +385,83 @@ def compute_XX_corr(data):
 
 
 def get_start_and_tauint(args, x, y, x_eq_spaced, y_eq_spaced, flowidx, dataindex, index_offset, stream_index):
+    # the streams are processed in parallel, so each one writes its own autocorrelation function
+    acoutfileName = "acor_stream" + str(stream_index + 1) + ".d"
     if args.blocksize:
         print("trying to optimize effective number of independent measurements, that is, nconf/tau_int.")
-        best_start, tau_int, tau_inte, tau_intbias, itpick = get_optimized_start_and_tauint(
-            x_eq_spaced, y_eq_spaced[:, flowidx, dataindex], index_offset, args.MC_stepsize, stream_index, args.blocksize, args.tpickmax_increment, args.include_bias)
+        best_start, tau_int, tau_inte, tau_intbias, itpick, all_tauint, nconf_eff_curve = get_optimized_start_and_tauint(
+            args, x_eq_spaced, y_eq_spaced, index_offset, stream_index, flowidx, dataindex, acoutfileName)
     else:
-        tau_int, tau_inte, tau_intbias, itpick, too_small, nconf = find_reliable_tauint(len(y_eq_spaced), index_offset, y[:, flowidx, dataindex],
-                                                                                        args.tpickmax_increment)
+        nconf_eff_curve = None
+        tau_int, tau_inte, tau_intbias, itpick, too_small, nconf, all_tauint = estimate_tauint(args, y, index_offset, len(y_eq_spaced), flowidx, dataindex,
+                                                                                               acoutfileName)
         print_result(stream_index + 1, x, index_offset, args.MC_stepsize, tau_int, tau_inte, tau_intbias, itpick, len(y_eq_spaced))
         if too_small:
             print_too_small_warning()
         else:
             print("")
         best_start = index_offset
-    return best_start, tau_int, tau_inte, tau_intbias, itpick
+    if all_tauint is not None and args.binlength_from == "max":
+        flow_max, column_max = numpy.unravel_index(numpy.argmax(all_tauint[0]), all_tauint[0].shape)
+        print("largest tau_int of all observables at flow index", flow_max, "and column", column_max)
+    return best_start, tau_int, tau_inte, tau_intbias, itpick, all_tauint, nconf_eff_curve
+
+
+def process_stream(stream, args, flowidx, dataindex):
+    """ equal spacing, tau_int estimation and binning of one stream=(k, confnums, data). returns x_eq_spaced, y_eq_spaced at flowidx and dataindex
+    (only this is plotted), [best_start, tau_int, tau_inte, tau_intbias, itpick], all_tauint, nconf_eff_curve, the binned data, the number of confs
+    before binning and the printed output. """
+    k, x, y = stream
+    # the output is printed by the main process in stream order. if the stream fails, print what it has output so far right away
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            print(k+1)
+            if args.already_equally_spaced:
+                x_eq_spaced = x
+                y_eq_spaced = y
+            else:
+                x_eq_spaced, y_eq_spaced, summary = get_equally_spaced_timeseries(x, y, args.MC_stepsize)
+                print_timeseries_summary(summary)
+
+            index_offset = numpy.argmin(numpy.abs(x_eq_spaced - args.min_conf[k] * args.MC_stepsize))
+            best_start, tau_int, tau_inte, tau_intbias, itpick, all_tauint, nconf_eff_curve = get_start_and_tauint(args, x, y, x_eq_spaced, y_eq_spaced,
+                                                                                                                  flowidx, dataindex, index_offset, k)
+
+            # reverse order
+            y_reversed = numpy.flip(y_eq_spaced, axis=0)
+
+            ndata = 0
+            if args.skip_binning:
+                y_binned = y_reversed
+            else:
+                ndata = len(y_reversed) - best_start
+
+                # unreasonably high tau_int estimates with large tau_inte can occur sometimes (mainly for short streams).
+                # with our current setup, we know from equivalent longer streams that the typical autocorrelation time is ~10-30 with relative errors <20%.
+                # therefore, we manually cap the binlength at 30 if the relative error is larger 20%. This only happens in a handful of cases.
+                # TODO make these parameters variable instead of hardcoded
+                if tau_int > 30 and tau_inte/tau_int > 0.2:
+                    binlength = 30
+                    print("INFO: binlength capped at 30 for unreliable estimates.")
+                else:
+                    binlength = max(1, int(tau_int))
+                nbins = int(ndata / binlength)
+                y_binned = numpy.mean(y_reversed[:nbins * binlength].reshape(nbins, binlength, *y_reversed.shape[1:]), axis=1)
+
+            return (x_eq_spaced, y_eq_spaced[:, flowidx, dataindex], [best_start, tau_int, tau_inte, tau_intbias, itpick], all_tauint, nconf_eff_curve,
+                    y_binned, ndata, output.getvalue())
+    except Exception:
+        print("ERROR: processing of stream", k+1, "failed. its output so far:")
+        print(output.getvalue(), end="", flush=True)
+        raise
 
 
 def parse_args():
     # TODO sort arguments according to their purpose
 
     # TODO add custom ylims here
-    parser, requiredNamed = lpd.get_parser()
+    parser, requiredNamed = lpd.get_parser(allow_all_corrs=True)
     requiredNamed.add_argument('--conftype', help='format example: s096t32_b0824900_m002022_m01011', type=str, required=True)
     parser.add_argument('--outputpath', help='where to store the plot', type=str)
     parser.add_argument('--show_id', help="list of indices that shall be plotted. e.g. 0 1 2 3 for the first 4 streams. default=show all streams.", type=int,
@@ -363,12 +484,25 @@ def parse_args():
                                                                           "then we never observe a decrease in the tau_int estimate and may underestimate tau_int."
                                                                           "so we keep increasing the binsize by <tpickmax_increment> and try again until we do.")
     parser.add_argument('--flowradius_T', default=0.15, type=float, help="at which flowtime in units of inverse temperature tau_int should be calculated")
+    parser.add_argument('--tauint_method', default="fft", choices=["fft", "jackknife"],
+                        help="fft: tau_int of all flow times and taus at once from the FFT autocorrelation function with automatic windowing. "
+                             "jackknife: tau_int of the polyakov loop at --flowradius_T from latqcdtools getTauInt with increasing tpickmax.")
+    parser.add_argument('--binlength_from', default="polyakov", choices=["polyakov", "max"],
+                        help="which tau_int determines the bin length: the one of the polyakov loop at --flowradius_T, or the largest one of all flow "
+                             "times and taus (only with --tauint_method fft).")
     parser.add_argument('--n_samples', default=10000, type=int, help="number of bootstrap samples to draw")
-    parser.add_argument('--n_proc', default=20, type=int, help="number of processes for parallelization")
+    parser.add_argument('--flow_cov_band', default=None, type=int,
+                        help="only keep the flow covariance of flow times that are at most this many indices apart, as the flow time extrapolation only "
+                             "combines nearby flow times. default: all flow times.")
+    parser.add_argument('--n_proc', default=20, type=int, help="number of processes for the parallel processing of the streams")
     parser.add_argument('--update_str', default="traj", help="what to call the gauge updates in the plot xlabel")
 
     args = parser.parse_args()
 
+    if args.binlength_from == "max" and args.tauint_method != "fft":
+        print("ERROR: --binlength_from max needs --tauint_method fft")
+        exit(1)
+
     return args
 
 
@@ -380,13 +514,10 @@ def main():
 
     # TODO add option to choose between full correlator or only numerator or denominator
 
-    # load and reorganize data
-    flow_times, n_flow, n_datafiles, n_streams, n_files_per_stream, XX_data, confnums = load_merged_data(args.qcdtype, args.corr, args.conftype,
-                                                                                                            args.basepath, None)
-    polyakov_real = XX_data[1]
-    numerator_real = XX_data[0]
-
-    data = numpy.concatenate((numerator_real, polyakov_real), axis=2)
+    # load and reorganize data. with --corr all, the numerators of all correlators are binned and resampled together.
+    corrs = find_merged_corrs(args.qcdtype, args.conftype, args.basepath) if args.corr == "all" else [args.corr]
+    flow_times, n_flow, n_datafiles, n_streams, n_files_per_stream, data, confnums = load_joint_merged_data(args.qcdtype, corrs, args.conftype,
+                                                                                                              args.basepath)
     index_selection = dict(polyakovloop=-1, numerator_at_largest_tau=-2)
     dataindex = index_selection["polyakovloop"]
 
@@ -398,70 +529,38 @@ def main():
     flowradii = numpy.sqrt(8 * flow_times)/nt
     flowidx = numpy.argmin(numpy.abs(flowradii - args.flowradius_T))
 
-    # separate data into streams
-    x_eq_spaced_array = []
-    y_eq_spaced_array = []
-    results = []
+    # separate data into streams and process them in parallel. the output of each stream is printed afterwards in stream order.
+    streams = []
     offset = 0
-
-    y_binned = []
-    total_ndata = 0
-
-    print("=========")
     for k in range(n_streams):
-        print(k+1)
-        x = numpy.asarray(confnums[k])
-        y = data[offset:offset + n_files_per_stream[k]]
+        streams.append((k, numpy.asarray(confnums[k]), data[offset:offset + n_files_per_stream[k]]))
         offset += n_files_per_stream[k]
+    x_eq_spaced_array, y_eq_spaced_array, results, all_tauints, nconf_eff_curves, y_binned, ndatas, outputs = lpd.parallel_function_eval(
+        process_stream, streams, min(args.n_proc, n_streams), args, flowidx, dataindex)
+    total_ndata = sum(ndatas)
 
-        if args.already_equally_spaced:
-            x_eq_spaced = x
-            y_eq_spaced = y
-        else:
-            x_eq_spaced, y_eq_spaced = get_equally_spaced_timeseries(x, y, args.MC_stepsize)
-        x_eq_spaced_array.append(x_eq_spaced)
-        y_eq_spaced_array.append(y_eq_spaced)
-
-        index_offset = numpy.argmin(numpy.abs(x_eq_spaced - args.min_conf[k] * args.MC_stepsize))
-        best_start, tau_int, tau_inte, tau_intbias, itpick = get_start_and_tauint(args, x, y, x_eq_spaced, y_eq_spaced, flowidx, dataindex, index_offset, k)
-
-        results.append([best_start, tau_int, tau_inte, tau_intbias, itpick])
-
-        # reverse order
-        y_eq_spaced = numpy.flip(y_eq_spaced, axis=0)
-
-        if args.skip_binning:
-            for val in y_eq_spaced:
-                y_binned.append(val)
-        else:
-            ndata = len(y_eq_spaced) - best_start
-            total_ndata += ndata
-
-            # unreasonably high tau_int estimates with large tau_inte can occur sometimes (mainly for short streams).
-            # with our current setup, we know from equivalent longer streams that the typical autocorrelation time is ~10-30 with relative errors <20%.
-            # therefore, we manually cap the binlength at 30 if the relative error is larger 20%. This only happens in a handful of cases.
-            # TODO make these parameters variable instead of hardcoded
-            if tau_int > 30 and tau_inte/tau_int > 0.2:
-                binlength = 30
-                print("INFO: binlength capped at 30 for unreliable estimates.")
-            else:
-                binlength = int(tau_int)
-            nbins = int(ndata / binlength)
-            for b in range(nbins):
-                y_binned.append(numpy.mean(y_eq_spaced[b * binlength:(b + 1) * binlength], axis=0))
+    print("=========")
+    for output in outputs:
+        print(output, end="")
         print("=========")
 
     print("Total number of confs before binning:", total_ndata)
 
-    y_binned = numpy.asarray(y_binned)
+    y_binned = numpy.concatenate(y_binned)
     if len(y_binned) < n_datafiles:
         print(args.conftype, "binned ", n_datafiles, "files into ", len(y_binned), "independent bins")
 
-    plot_MC_time(x_eq_spaced_array, y_eq_spaced_array, flowidx, dataindex, results, args, flow_times[flowidx], nt, ns, beta)
-
-    outputfolder = lpd.get_merged_data_path(args.qcdtype, args.corr, args.conftype, args.basepath)
-    resample_and_save_data(compute_XX_corr, y_binned, args.n_samples, len(y_binned),
-                              outputfolder + "/" + args.corr, flow_times, args.qcdtype, args.conftype, args.corr, nt, False, args.n_proc, 0)
+    plot_MC_time(x_eq_spaced_array, y_eq_spaced_array, results, args, flow_times[flowidx], nt, ns, beta, nconf_eff_curves)
+
+    file_prefixes = [lpd.get_merged_data_path(args.qcdtype, corr, args.conftype, args.basepath) + "/" + corr for corr in corrs]
+    if args.tauint_method == "fft":
+        # tau_int and its error of every observable (flow time, tau and polyakov loop as last column) of every stream
+        all_tauints = numpy.asarray(all_tauints)
+        for c, (corr, file_prefix) in enumerate(zip(corrs, file_prefixes)):
+            numpy.save(lpd.print_var("write", file_prefix + "_tauint_" + args.conftype + ".npy"),
+                       numpy.concatenate((all_tauints[..., c*nt_half:(c+1)*nt_half], all_tauints[..., -1:]), axis=-1))
+    resample_and_save_data(y_binned, args.n_samples, len(y_binned), file_prefixes, flow_times, args.qcdtype, args.conftype, corrs, nt, False,
+                           args.flow_cov_band)
 
     print("done", args.conftype)
 
@@ -4,7 +4,6 @@
 
 import numpy
 import lib_process_data as lpd
-import scipy.interpolate
 import matplotlib.pyplot
 from matplotlib.backends.backend_pdf import PdfPages
 
@@ -15,9 +14,13 @@ matplotlib.rcParams['figure.max_open_warning'] = 0  # suppress warning due to po
 
 
 def interpolate_XX_flow(xdata, ydata, ydata_norm, output_xdata1, output_xdata2):
-    spline = scipy.interpolate.CubicSpline(xdata, ydata, bc_type=((2, 0.0), (1, 0.0)))  # true interpolating spline
-    norm = scipy.interpolate.CubicSpline(xdata, ydata_norm, bc_type=((2, 0.0), (1, 0.0)))  # true interpolating spline
-    return spline(output_xdata1)/norm(output_xdata1), spline(output_xdata2)/norm(output_xdata2)
+    """ interpolate ydata of shape (nsamples, len(xdata)) (or a single sample) with true interpolating splines and divide by the interpolation of
+    ydata_norm. all samples are done at once with lpd.cubic_spline_operator. """
+    results = []
+    for output_xdata in (output_xdata1, output_xdata2):
+        operator = lpd.cubic_spline_operator(xdata, output_xdata, bc_type=((2, 0.0), (1, 0.0)))
+        results.append((ydata @ operator.T) / (operator @ ydata_norm))
+    return results
 
 
 def plot(args, flowradius, x, y, yerr, merged_data_path, index, flowtime, nt, flowaction, gaugeaction):
@@ -39,9 +42,9 @@ def plot(args, flowradius, x, y, yerr, merged_data_path, index, flowtime, nt, fl
     #data
     XX = numpy.loadtxt(merged_data_path + "/" + args.corr + "_" + args.conftype + ".dat")
     XX_err = numpy.loadtxt(merged_data_path + "/" + args.corr + "_err_" + args.conftype + ".dat")
-    for a in range(len(XX[index])):
-        XX[index, a] = XX[index, a] * nt ** 4 / lpd.G_latt_LO_flow(a, flowtime, args.corr, nt, flowaction, gaugeaction)
-        XX_err[index, a] = XX_err[index, a] * nt ** 4 / numpy.fabs(lpd.G_latt_LO_flow(a, flowtime, args.corr, nt, flowaction, gaugeaction))
+    norm = lpd.get_tree_level_normalization(flowtime, args.corr, nt, flowaction, gaugeaction)[0]
+    XX[index] = XX[index] * norm
+    XX_err[index] = XX_err[index] * numpy.fabs(norm)
     x = lpd.get_tauTs(nt)
     min_index = numpy.ceil(numpy.fabs(x*nt - lower_limit*nt)).argmin()+1
     ax.errorbar(x[min_index:], XX[index][min_index:], XX_err[index][min_index:], fmt='|', label="data")
@@ -59,39 +62,29 @@ def tau_interpolation(index, flowtimes, XX_samples, args, merged_data_path):
     flowradius = numpy.sqrt(flowtimes[index]*8)/nt
 
     # get interpolation of the tree-level improvement factor
-    ydata_norm = []
-    for a in range(nt_half):
-        ydata_norm.append(
-            lpd.G_latt_LO_flow(a, flowtime, args.corr, nt, flowaction, gaugeaction) / lpd.G_latt_LO_flow(a, 0, args.corr, nt, flowaction, gaugeaction))
+    norm = lpd.get_tree_level_normalization(flowtimes, args.corr, nt, flowaction, gaugeaction)[index]
+    factor = lpd.get_tree_level_normalization(0, args.corr, nt, flowaction, gaugeaction)[0]
+    ydata_norm = factor / norm
 
-    theoutputdata = []
-    theplotdata = []
     xpoints = lpd.get_tauTs(args.int_Nt)
     xpointsplot = numpy.linspace(0, xpoints[-1], 1000)
 
-    # perform spline fits for each sample
-    for m in range(args.nsamples):
-        ydata = numpy.asarray(XX_samples[m, index])
-        for a in range(nt_half):
-            # We use tf=0 here so that the interpolation works better. Afterwards we divide it out again.
-            ydata[a] = ydata[a] * nt ** 4 / lpd.G_latt_LO_flow(a, 0, args.corr, nt, flowaction, gaugeaction)
-        output, plot_output = interpolate_XX_flow(lpd.get_tauTs(nt), ydata, ydata_norm, xpoints, xpointsplot)
-        theoutputdata.append(output)
-        theplotdata.append(plot_output)
+    # We use tf=0 here so that the interpolation works better. Afterwards we divide it out again.
+    ydata = XX_samples[:args.nsamples, index] * factor
+
+    # perform spline fits for all samples at once
+    theoutputdata, theplotdata = interpolate_XX_flow(lpd.get_tauTs(nt), ydata, ydata_norm, xpoints, xpointsplot)
 
     yplot = numpy.mean(theplotdata, axis=0)
-    eplot = numpy.std(theplotdata, axis=0)
 
-    fig = plot(args, flowradius, xpointsplot, yplot, eplot, merged_data_path, index, flowtime, nt, flowaction, gaugeaction)
+    fig = None
+    if not args.no_plots:
+        eplot = numpy.std(theplotdata, axis=0)
+        fig = plot(args, flowradius, xpointsplot, yplot, eplot, merged_data_path, index, flowtime, nt, flowaction, gaugeaction)
 
     return theoutputdata, fig, yplot
 
 
-def interpolate_data(xdata, ydata, output_xdata, bc=((2, 0.0), (2, 0.0))):
-    spline = scipy.interpolate.CubicSpline(xdata, ydata, bc_type=bc, extrapolate=False)
-    return spline(output_xdata)
-
-
 def parse_args():
     # parse cmd line arguments
     parser, requiredNamed = lpd.get_parser()
@@ -99,6 +92,7 @@ def parse_args():
     requiredNamed.add_argument('--conftype', help="format: s096t20_b0824900 for quenched or s096t20_b0824900_m002022_m01011 for hisq", required=True)
     parser.add_argument('--nsamples', help="number of gaussian bootstrap samples that are contained in the input files", type=int, default=1000)
     parser.add_argument('--int_Nt', help='use tauT of this Nt as xdata for the interpolation output', type=int, default=36)
+    parser.add_argument('--no_plots', '--no-plots', help="only compute and save the data, don't create any figures", action="store_true")
     parser.add_argument('--ylims', default=[-0.2, 4], nargs=2, type=float, help="custom ylims for plot")
     parser.add_argument('--nproc', type=int, default=20, help="number of parallel processes (different flow times can be interpolated independently)")
     parser.add_argument('--basepath', type=str, help="where to look for the data")
@@ -122,10 +116,14 @@ def save_data(args, merged_data_path, interpolations, interpolation_mean_for_plo
     numpy.save(file, interpolation_mean_for_plotting)
 
 
-def save_figs(args, figs, suffix="interpolation"):
+def get_figs_path(args, suffix="interpolation"):
     outputfolder_plot = lpd.get_plot_path(args.qcdtype, args.corr, args.conftype, args.basepath_plot)
     lpd.create_folder(outputfolder_plot)
-    filepath = outputfolder_plot + "/" + args.corr + "_" + suffix + ".pdf"
+    return outputfolder_plot + "/" + args.corr + "_" + suffix + ".pdf"
+
+
+def save_figs(args, figs, suffix="interpolation"):
+    filepath = get_figs_path(args, suffix)
     print("saving ", filepath)
 
     lpd.set_rc_params()  # for some reason we need to call this here...
@@ -139,16 +137,21 @@ def convert_sqrt8tauFT_to_tauFBya2(sqrt8tauFT, nt):
     return (sqrt8tauFT*nt)**2/8
 
 
-def traditional_interpolation(args, merged_data_path, flowtimes, XX_samples):
+def traditional_interpolation(args, merged_data_path, flowtimes, XX_samples, pool):
     matplotlib.rcParams['figure.max_open_warning'] = 0  # suppress warning due to possibly large number of figures...
     indices = range(len(flowtimes))
-    interpolations, figs, interpolation_mean_for_plotting = lpd.parallel_function_eval(tau_interpolation, indices, args.nproc, flowtimes, XX_samples, args, merged_data_path)
+    out = (numpy.empty((len(indices), len(XX_samples[:args.nsamples]), len(lpd.get_tauTs(args.int_Nt)))), None, numpy.empty((len(indices), 1000)))
+    # the workers save the figures themselves
+    figures = (None, None if args.no_plots else get_figs_path(args), None)
+    interpolations, _, interpolation_mean_for_plotting = lpd.parallel_function_eval(tau_interpolation, indices, args.nproc, flowtimes, XX_samples, args,
+                                                                                    merged_data_path, out=out, figures=figures, pool=pool)
 
-    save_figs(args, figs)
     save_data(args, merged_data_path, interpolations, interpolation_mean_for_plotting)
 
 
-def interpolate_to_relative_flowtimes(tauT_index, tauTs, XX_samples, args, absolute_flowtimes, relative_flowradii):
+def get_flow_interpolation_operator(tauT_index, tauTs, args, absolute_flowtimes, relative_flowradii):
+    """ the well-behaved flow indices and the operator of shape (len(relative_flowradii), number of these flow indices) that maps the samples of this
+    tau at these flow times to the tree-level normalized interpolation at the given relative flow radii (nan outside of the flow time range) """
     def flip_last_false_before_first_true(arr):
         idx = None
         for i, val in enumerate(arr):
@@ -162,46 +165,58 @@ def interpolate_to_relative_flowtimes(tauT_index, tauTs, XX_samples, args, absol
     _, _, nt, _ = lpd.parse_conftype(args.conftype)
     _, _, _, gaugeaction, flowaction = lpd.parse_qcdtype(args.qcdtype)
 
-    new_XX_samples = numpy.empty((args.nsamples, len(relative_flowradii)))
-
     # only use well-behaved part for interpolation
     flow_indices = flip_last_false_before_first_true((absolute_flowtimes >= 1 / 8) & (absolute_flowtimes <= convert_sqrt8tauFT_to_tauFBya2(0.35 * 0.5, nt)))
 
     new_absolute_flowtimes = convert_sqrt8tauFT_to_tauFBya2(relative_flowradii * tauTs[tauT_index], nt)
-    factor = nt**4 / lpd.G_latt_LO_flow(tauT_index, absolute_flowtimes[flow_indices], args.corr, nt, flowaction, gaugeaction)
-    for m in range(args.nsamples):
-        ydata_old = XX_samples[m, flow_indices, tauT_index] * factor
-        new_XX_samples[m] = interpolate_data(absolute_flowtimes[flow_indices], ydata_old, new_absolute_flowtimes)
+    factor = lpd.get_tree_level_normalization(absolute_flowtimes[flow_indices], args.corr, nt, flowaction, gaugeaction)[:, tauT_index]
+    operator = lpd.cubic_spline_operator(absolute_flowtimes[flow_indices], new_absolute_flowtimes, bc_type=((2, 0.0), (2, 0.0)), extrapolate=False)
+    return flow_indices, operator * factor
 
-    return new_XX_samples
 
+def get_relflow_flow_operators(args, absolute_flowtimes, relflow_range):
+    """ the flow indices and the operators of get_flow_interpolation_operator for all taus of the lattice, of shape (Ntau/2, len(relflow_range),
+    number of flow indices) """
+    _, _, nt, nt_half = lpd.parse_conftype(args.conftype)
+    orig_tauTs = lpd.get_tauTs(nt)
 
-def interpolate_tauTs_at_relative_flowtime(flow_index, args, XX_samples, int_tauTs):
-    def first_non_nan_index(arr):
-        for i, value in enumerate(arr):
-            if not numpy.isnan(value):
-                return i
-        return None
+    flow_operators = [get_flow_interpolation_operator(a, orig_tauTs, args, absolute_flowtimes, relflow_range) for a in range(nt_half)]
+    return flow_operators[0][0], numpy.stack([operator for _, operator in flow_operators])
 
-    def first_non_nan_index_from_end(arr):
-        for i in range(len(arr) - 1, -1, -1):
-            if not numpy.isnan(arr[i]):
-                return i
-        return None
 
-    _, _, nt, _ = lpd.parse_conftype(args.conftype)
+def interpolate_to_relative_flowtimes(XX_samples, flow_indices, flow_operators, nsamples):
+    """ the interpolations in flow time alone, of shape (nsamples, number of relative flow times, Ntau/2) """
+    return numpy.einsum('nft,trf->nrt', XX_samples[:nsamples, flow_indices], flow_operators)
+
+
+def get_relflow_operators(args, absolute_flowtimes, relflow_range, output_tauTs):
+    """ interpolation in flow time to the relative flow times (get_relflow_flow_operators) followed by the interpolation in tau to output_tauTs,
+    composed into one operator per relative flow time. each has the shape (len(output_tauTs), number of flow indices * Ntau/2) and acts on the
+    samples at the returned flow indices, flattened over flow times and taus. only the taus at which the relative flow time lies inside the flow
+    time range of the data enter the interpolation in tau. """
+    _, _, nt, nt_half = lpd.parse_conftype(args.conftype)
     orig_tauTs = lpd.get_tauTs(nt)
 
-    new_XX_samples = numpy.empty((args.nsamples, len(int_tauTs)))
+    flow_indices, flow_operators = get_relflow_flow_operators(args, absolute_flowtimes, relflow_range)  # (tau, relflow, flow)
 
-    first_not_nan_index = first_non_nan_index(XX_samples[0, flow_index])
-    last_not_nan_index = first_non_nan_index_from_end(XX_samples[0, flow_index])
+    operators = []
+    for r in range(len(relflow_range)):
+        valid = numpy.flatnonzero(~numpy.isnan(flow_operators[:, r]).any(axis=1))
+        operator = numpy.zeros((len(output_tauTs), flow_operators.shape[2], nt_half))
+        if len(valid) == 0:
+            operator[:] = numpy.nan
+        else:
+            taus = slice(valid[0], valid[-1] + 1)
+            tau_operator = lpd.cubic_spline_operator(orig_tauTs[taus], output_tauTs, bc_type=((2, 0.0), (1, 0.0)), extrapolate=False)
+            operator[:, :, taus] = numpy.einsum('kt,tf->kft', tau_operator, flow_operators[taus, r])
+        operators.append(operator.reshape(len(output_tauTs), -1))
+    return flow_indices, operators
 
-    for m in range(args.nsamples):
-        ydata_old = XX_samples[m, flow_index][first_not_nan_index:last_not_nan_index+1]
-        new_XX_samples[m] = interpolate_data(orig_tauTs[first_not_nan_index:last_not_nan_index+1], ydata_old, int_tauTs, bc=((2, 0.0), (1, 0.0)))
 
-    return new_XX_samples
+def apply_relflow_operators(XX_samples, flow_indices, operators, nsamples):
+    """ the interpolations of shape (number of relative flow times, nsamples, len(output_tauTs)) from the operators of get_relflow_operators """
+    samples = numpy.asarray(XX_samples[:nsamples, flow_indices]).reshape(nsamples, -1)
+    return numpy.stack([samples @ operator.T for operator in operators])
 
 
 def plot_relative_flow_ints(flowindex, args, relflow_range, orig_XX_samples, int_XX_samples, int_xdata):
@@ -267,38 +282,32 @@ def plot_relative_flow_ints_combined(indices, args, relflow_range, orig_XX_sampl
     return fig
 
 
-def new_interpolation(args, merged_data_path, flowtimes, XX_samples):
-    _, _, nt, nt_half = lpd.parse_conftype(args.conftype)
-
+def new_interpolation(args, merged_data_path, flowtimes, XX_samples, pool):
     relflow_range = lpd.get_relflow_range()
     nflow = len(relflow_range)
 
-    orig_xdata = lpd.get_tauTs(nt)
-
-    # interpolate_to_relative_flowtimes
-    flow_int_XX_samples = lpd.parallel_function_eval(interpolate_to_relative_flowtimes, range(nt_half), args.nproc, orig_xdata, XX_samples, args, flowtimes, relflow_range)
-    flow_int_XX_samples = numpy.asarray(flow_int_XX_samples).swapaxes(0, 2)
-    flow_int_XX_samples = flow_int_XX_samples.swapaxes(0, 1)
-
-    # interpolate to tauTs of finest lattice
-    tauT_int_flow_int_XX_samples = lpd.parallel_function_eval(interpolate_tauTs_at_relative_flowtime, range(len(relflow_range)), args.nproc,
-                                                              args, flow_int_XX_samples, lpd.get_tauTs(args.int_Nt))
-    tauT_int_flow_int_XX_samples = numpy.asarray(tauT_int_flow_int_XX_samples)
-
-    # interpolate to all the tauTs for the plot
+    # interpolate in flow time and then in tau, both at once for all samples with one precomputed operator per relative flow time.
+    # first to the tauTs of the finest lattice, then to all the tauTs for the plot
+    flow_indices, operators = get_relflow_operators(args, flowtimes, relflow_range, lpd.get_tauTs(args.int_Nt))
+    tauT_int_flow_int_XX_samples = apply_relflow_operators(XX_samples, flow_indices, operators, args.nsamples)
     int_xdata = numpy.linspace(0, 0.5, 200)
-    plot_tauT_int_flow_int_XX_samples = lpd.parallel_function_eval(interpolate_tauTs_at_relative_flowtime, range(len(relflow_range)), args.nproc,
-                                                                   args, flow_int_XX_samples, int_xdata)
-    plot_tauT_int_flow_int_XX_samples = numpy.asarray(plot_tauT_int_flow_int_XX_samples).swapaxes(0, 1)
+    flow_indices, operators = get_relflow_operators(args, flowtimes, relflow_range, int_xdata)
+    plot_tauT_int_flow_int_XX_samples = apply_relflow_operators(XX_samples, flow_indices, operators, args.nsamples).swapaxes(0, 1)
 
     numpy.savetxt(merged_data_path + args.corr + "_" + args.conftype + "_relflows.txt", relflow_range, fmt='%.4f')
     save_data(args, merged_data_path, tauT_int_flow_int_XX_samples, numpy.median(plot_tauT_int_flow_int_XX_samples, axis=0), suffix="interpolation_relflow")
 
-    # create figs
-    figs = lpd.parallel_function_eval(plot_relative_flow_ints, range(nflow), args.nproc, args, relflow_range,
-                                      flow_int_XX_samples, plot_tauT_int_flow_int_XX_samples, int_xdata)
+    if args.no_plots:
+        return
+
+    # the interpolation in flow time alone is only needed to plot the data at the relative flow times
+    flow_indices, flow_operators = get_relflow_flow_operators(args, flowtimes, relflow_range)
+    flow_int_XX_samples = interpolate_to_relative_flowtimes(XX_samples, flow_indices, flow_operators, args.nsamples)
 
-    save_figs(args, figs, suffix="interpolation_relflow")
+    # create figs. the workers save them themselves
+    lpd.parallel_function_eval(plot_relative_flow_ints, range(nflow), args.nproc, args, relflow_range,
+                               flow_int_XX_samples, plot_tauT_int_flow_int_XX_samples, int_xdata, figures=get_figs_path(args, suffix="interpolation_relflow"),
+                               pool=pool)
 
     fig_combined = plot_relative_flow_ints_combined([10, 20], args, relflow_range,
                                       flow_int_XX_samples, plot_tauT_int_flow_int_XX_samples, int_xdata)
@@ -314,8 +323,9 @@ def main():
     flowtimes = numpy.loadtxt(merged_data_path + "/flowtimes_" + args.conftype + ".dat")
     XX_samples = numpy.load(merged_data_path + "/" + args.corr + "_" + args.conftype + "_samples.npy")
 
-    # traditional_interpolation(args, merged_data_path, flowtimes, XX_samples)
-    new_interpolation(args, merged_data_path, flowtimes, XX_samples)
+    with lpd.WorkerPool(args.nproc) as pool:
+        # traditional_interpolation(args, merged_data_path, flowtimes, XX_samples, pool)
+        new_interpolation(args, merged_data_path, flowtimes, XX_samples, pool)
 
 
 if __name__ == '__main__':
@@ -4,7 +4,6 @@ import lib_process_data as lpd
 import numpy
 import matplotlib
 import scipy.optimize
-from matplotlib.backends.backend_pdf import PdfPages
 import warnings
 
 warnings.filterwarnings('ignore', r'All-NaN (slice|axis) encountered.*')
@@ -23,10 +22,13 @@ def main():
     samples = load_data(args)
     edatas = get_weights(samples)
 
-    if not args.relflow:
-        traditional_extr(args, samples, edatas, nt_finest, Nts)
-    else:
-        new_extr(args, samples, edatas, nt_finest, Nts)
+    # one pool for all stages, which all get the samples from the same shared memory
+    with lpd.WorkerPool(args.nproc) as pool:
+        samples = pool.share(samples)
+        if not args.relflow:
+            traditional_extr(args, samples, edatas, nt_finest, Nts, pool)
+        else:
+            new_extr(args, samples, edatas, nt_finest, Nts, pool)
 
 
 def parse_args():
@@ -51,6 +53,7 @@ def parse_args():
     parser.add_argument('--ansatz', type=str, choices=["linear", "constant", "custom"], default="linear")
     parser.add_argument('--relflow', action="store_true")
     parser.add_argument('--combined_fit', action="store_true")
+    parser.add_argument('--no_plots', '--no-plots', help="only compute and save the data, don't create any figures", action="store_true")
     parser.add_argument('--nsamples', type=int, default=None)
     parser.add_argument('--nterms', help='how many terms to add in the slope of the combined fit', default=1, choices=[1, 2], type=int)
 
@@ -59,10 +62,13 @@ def parse_args():
     global n_additional_fitparams
     n_additional_fitparams = args.nterms
     global combined_fit_ansatz
+    global combined_fit_powers
     if args.nterms == 1:
         combined_fit_ansatz = combined_fit_ansatz_1
+        combined_fit_powers = combined_fit_powers_1
     elif args.nterms == 2:
         combined_fit_ansatz = combined_fit_ansatz_2
+        combined_fit_powers = combined_fit_powers_2
 
     return args
 
@@ -118,6 +124,26 @@ def linear_ansatz(x, b, m, chisq_dof=None):
     return m * x + b
 
 
+def fit_linear(ydata, xdata, edata):
+    """ weighted least squares fit of linear_ansatz in closed form, for many data sets at once. ydata has the shape (..., len(xdata)) and edata is
+    broadcastable to it. returns the intercepts, slopes and chisq/dof, each of shape ydata.shape[:-1] (nan wherever ydata or edata contain a nan).
+    gives the same as curve_fit with sigma=edata, see fit_sample. """
+    xdata = numpy.asarray(xdata, dtype=float)
+    weights = numpy.broadcast_to(1 / numpy.asarray(edata, dtype=float) ** 2, numpy.shape(ydata))
+    S = numpy.sum(weights, axis=-1)
+    Sx = weights @ xdata
+    Sxx = weights @ xdata ** 2
+    Sy = numpy.sum(weights * ydata, axis=-1)
+    Sxy = numpy.sum(weights * ydata * xdata, axis=-1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        det = S * Sxx - Sx ** 2
+        intercepts = (Sxx * Sy - Sx * Sxy) / det
+        slopes = (S * Sxy - Sx * Sy) / det
+        chisq = numpy.sum(weights * (linear_ansatz(xdata, intercepts[..., None], slopes[..., None]) - ydata) ** 2, axis=-1)
+        chisqdof = chisq / (len(xdata) - 2)
+    return intercepts, slopes, chisqdof
+
+
 def fit_sample(ydata, xdata, edata):
     def chisq_dof(fitparams, ydata, xdata, edata, extrapolation_ansatz):
         ndata = len(ydata)
@@ -139,7 +165,7 @@ def fit_sample(ydata, xdata, edata):
         return [numpy.nan] * (len(start_params) + 1)
 
 
-def traditional_extr(args, samples, edatas, nt_finest, Nts):
+def traditional_extr(args, samples, edatas, nt_finest, Nts, pool):
     def load_flowtimes(args):
         # load flow times from finest lattice
         flowtimes = numpy.loadtxt(
@@ -154,10 +180,12 @@ def traditional_extr(args, samples, edatas, nt_finest, Nts):
     print("calculate extrapolation and create figures...")
     print("      ", lpd.get_tauTs(nt_finest))
     flowtimes, indices = load_flowtimes(args)
-    fitparams, figs_corr, figs_extr = lpd.parallel_function_eval(wrapper, indices, args.nproc, flowtimes, samples, args, Nts, edatas)
+    # the workers save the figures themselves
+    fitparams = numpy.empty((len(indices), samples.shape[2], int(nt_finest/2), 3))
+    figures = (None, None, None) if args.no_plots else (None, get_figs_path(args, "_cont"), get_figs_path(args, "_cont_quality"))
+    fitparams, _, _ = lpd.parallel_function_eval(wrapper, indices, args.nproc, flowtimes, samples, args, Nts, edatas,
+                                                 out=(fitparams, None, None), figures=figures, pool=pool)
 
-    save_figs(args, figs_corr, "_cont")
-    save_figs(args, figs_extr, "_cont_quality")
     save_data(args, fitparams, flowtimes, nt_finest)
 
     return
@@ -188,18 +216,13 @@ def wrapper(index, flowtimes, samples, args, Nts, edatas):
     results = numpy.empty((nsamples, nt_half_fine, 3))
     results[:] = numpy.nan
 
-    # at fixed flowtime, perform cont extr for each tauT for each sample
-    if flowradius >= args.min_flowradius:
-        for j, tauT in enumerate(tauTs_fine):
-            xdata = numpy.asarray([1 / Ntau ** 2 for k, Ntau in enumerate(Nts)])
-
-            if tauT in valid_tauTs and len(xdata) >= 2:
-
-                for m in range(nsamples):
-                    ydata = [conftype_samples[index][m, j] for conftype_samples in samples]
-                    edata = [conftype_edata[index, j] for conftype_edata in edatas]
-
-                    results[m][j] = fit_sample(ydata, xdata, edata)
+    # at fixed flowtime, perform cont extr for each tauT for each sample, all at once
+    xdata = numpy.asarray([1 / Ntau ** 2 for k, Ntau in enumerate(Nts)])
+    if flowradius >= args.min_flowradius and len(xdata) >= 2:
+        valid = numpy.asarray([tauT in valid_tauTs for tauT in tauTs_fine])
+        ydata = numpy.moveaxis(samples[:, index][:, :, valid], 0, -1)  # (sample, tauT, conftype)
+        edata = edatas[:, index, valid].T
+        results[:, valid] = numpy.stack(fit_linear(ydata, xdata, edata), axis=-1)
 
     # TODO else: load data
 
@@ -220,6 +243,9 @@ def wrapper(index, flowtimes, samples, args, Nts, edatas):
     if not numpy.isnan(chisqdof_mean).all():
         print(flowradius_str, chisqdof_mean)
 
+    if args.no_plots:
+        return results, None, None
+
     # merge continuum and data together into one object to pass it to the plot function
     plot_data = numpy.transpose(numpy.stack([continuum_mean, *[tmp for tmp in data_mean]]))
     plot_std = numpy.transpose(numpy.stack([continuum_std, *[tmp for tmp in data_std]]))
@@ -293,17 +319,10 @@ def plot_corr(args, xdata, ydata, edata, flowradius_str, lower_tauT_lim):
     return fig
 
 
-def save_figs(args, figs, suffix):
-    # save figures to pdf
-    print("save figures...")
-    lpd.set_rc_params()  # for some reason we need to repeat this here...
+def get_figs_path(args, suffix):
     plotpath = lpd.get_plot_path(args.qcdtype, args.corr, args.output_suffix, args.basepath_plot)
     lpd.create_folder(plotpath)
-    with PdfPages(plotpath + "/" + args.corr + suffix + ".pdf") as pdf:
-        for fig in figs:
-            if fig is not None:
-                pdf.savefig(fig)
-                matplotlib.pyplot.close(fig)
+    return plotpath + "/" + args.corr + suffix + ".pdf"
 
 
 def save_data(args, fitparams, flowtimes, nt_finest):
@@ -334,6 +353,7 @@ def save_data(args, fitparams, flowtimes, nt_finest):
 
 
 combined_fit_ansatz = None
+combined_fit_powers = None
 n_additional_fitparams = None
 
 
@@ -345,31 +365,40 @@ def combined_fit_ansatz_2(x, tauT, cont, a, b):
     return cont + (- (a / tauT) ** 2 - (b / tauT) ** 4) * x
 
 
-def perform_combined_fit(ydata, xdata, tauTs, edata, nparams):
-    def combined_chisqdof(fitparams, ydata, xdata, edata, tauTs):
-        ndata = ydata.size
-        ntauT = ydata.shape[1]
-        chisq = 0
-
-        combined_fitparams = fitparams[ntauT:]
-
-        for i in range(ntauT):
-            chisq += numpy.nansum(((combined_fit_ansatz(xdata, tauTs[i], fitparams[i], *combined_fitparams) - ydata[:, i]) / edata[:, i]) ** 2)
+# the slope of the ansatz is - sum_k (p_k / tauT) ** power_k, i.e. linear in the coefficients p_k ** power_k >= 0
+combined_fit_powers_1 = (2,)
+combined_fit_powers_2 = (2, 4)
 
-        nfitparams = len(fitparams)
-        chisqdof = chisq / (ndata - nfitparams)
-        return chisqdof
 
+def perform_combined_fit(ydata, xdata, tauTs, edata, nparams):
+    """ combined fit of all samples at once. ydata has the shape (nsamples, len(xdata), len(tauTs)), edata the shape (len(xdata), len(tauTs)).
+    returns the continuum values at all tauTs, the nparams slope parameters and chisq/dof for each sample.
+    the slope parameters only enter via p_k ** power_k, so the fit is done in these (linear) coefficients and their positive roots are returned. """
     ntauT = len(tauTs)
-    fitparams = scipy.optimize.minimize(combined_chisqdof, x0=numpy.asarray([*[1 for _ in range(ntauT)], *[1 for _ in range(nparams)]]),
-                                        bounds=([*[(0, 20) for _ in range(ntauT)], (None, None), *[(None, None) for _ in range(nparams - 1)]]),
-                                        args=(ydata, xdata, edata, tauTs))
-    fitparams = fitparams.x
-    chisqdof = combined_chisqdof(fitparams, ydata, xdata, edata, tauTs)
-    return [*fitparams, chisqdof]
-
-
-def new_extr(args, samples, edatas, nt_finest, Nts):
+    nsamples = ydata.shape[0]
+    powers = numpy.asarray(combined_fit_powers[:nparams])
+    # the model is linear: ydata = design @ [cont_1, ..., cont_ntauT, p_1 ** power_1, ...]
+    design = numpy.concatenate([numpy.broadcast_to(numpy.eye(ntauT), (len(xdata), ntauT, ntauT)),
+                                - xdata[:, None, None] / tauTs[None, :, None] ** powers[None, None, :]], axis=-1).reshape(len(xdata) * ntauT, -1)
+
+    def model(fitparams):
+        return fitparams @ design.T
+
+    def jacobian(fitparams):
+        return numpy.broadcast_to(design, (len(fitparams), *design.shape))
+
+    lower = [*[0 for _ in range(ntauT)], *[0 for _ in range(nparams)]]
+    upper = [*[20 for _ in range(ntauT)], *[numpy.inf for _ in range(nparams)]]
+    fitparams, chisq, success = lpd.bounded_least_squares(model, jacobian, ydata.reshape(nsamples, -1), edata.reshape(-1),
+                                                          numpy.ones(ntauT + nparams), lower, upper)
+    if not numpy.all(success):
+        print("WARN: the combined fit of", numpy.count_nonzero(~success), "of", nsamples, "samples did not converge")
+    fitparams[:, ntauT:] = fitparams[:, ntauT:] ** (1 / powers)
+    chisqdof = chisq / (ydata[0].size - (ntauT + nparams))
+    return numpy.column_stack((fitparams, chisqdof))
+
+
+def new_extr(args, samples, edatas, nt_finest, Nts, pool):
     merged_data_path = lpd.get_merged_data_path(args.qcdtype, args.corr, args.conftypes[-1], args.basepath)
     relflows = numpy.loadtxt(merged_data_path + args.corr + "_" + args.conftypes[-1] + "_relflows.txt")
     nflow = len(relflows)
@@ -377,12 +406,12 @@ def new_extr(args, samples, edatas, nt_finest, Nts):
     nfitparams = int(nt_finest / 2) + n_additional_fitparams
 
     if args.combined_fit:
-        results = lpd.parallel_function_eval(combined_extr_at_relflow, range(nflow), args.nproc, args, samples, edatas, nfitparams, nt_finest, Nts)
-        results = numpy.asarray(results)
+        results = lpd.parallel_function_eval(combined_extr_at_relflow, range(nflow), args.nproc, args, samples, edatas, nfitparams, nt_finest, Nts,
+                                             out=numpy.empty((nflow, args.nsamples, nfitparams + 1)), pool=pool)
         results = results.swapaxes(0, 1)
     else:
-        results = lpd.parallel_function_eval(individual_extr_at_relflow, range(nflow), args.nproc, args, samples, edatas, nt_finest, Nts)
-        results = numpy.asarray(results)
+        results = lpd.parallel_function_eval(individual_extr_at_relflow, range(nflow), args.nproc, args, samples, edatas, nt_finest, Nts,
+                                             out=numpy.empty((nflow, args.nsamples, int(nt_finest/2) * 3)), pool=pool)
         results = results.swapaxes(0, 1)
 
     print("results shape", results.shape)
@@ -391,10 +420,13 @@ def new_extr(args, samples, edatas, nt_finest, Nts):
     # save data
     save_relflow_data(args, results, relflows, nt_finest)
 
-    # plot extr
+    if args.no_plots:
+        return
+
+    # plot extr. the workers save the figures themselves
     xdata = 1 / numpy.asarray(Nts) ** 2
-    figs = lpd.parallel_function_eval(plot_relflow_extr, range(nflow), args.nproc, args, relflows, results, xdata, samples, edatas, lpd.get_tauTs(nt_finest))
-    save_figs(args, figs, "_cont_quality_relflow")
+    lpd.parallel_function_eval(plot_relflow_extr, range(nflow), args.nproc, args, relflows, results, xdata, samples, edatas, lpd.get_tauTs(nt_finest),
+                               figures=get_figs_path(args, "_cont_quality_relflow"), pool=pool)
 
 
 def combined_extr_at_relflow(index, args, samples, edatas, nfitparams, nt_finest, Nts):
@@ -412,11 +444,9 @@ def combined_extr_at_relflow(index, args, samples, edatas, nfitparams, nt_finest
 
     edata = numpy.asarray([conftype_edata[index][valid_tauT_indices] for conftype_edata in edatas])
 
-    for m in range(args.nsamples):
-        ydata = numpy.asarray([conftype_samples[index][m][valid_tauT_indices] for conftype_samples in samples])
-        fitresults = perform_combined_fit(ydata, xdata, tauTs_finest[valid_tauT_indices], edata, n_additional_fitparams)
-        for i, val in enumerate(fitresults):
-            results[m][offset + i] = val
+    ydata = numpy.moveaxis(samples[:, index, :args.nsamples][:, :, valid_tauT_indices], 0, 1)  # (sample, conftype, tauT)
+    fitresults = perform_combined_fit(ydata, xdata, tauTs_finest[valid_tauT_indices], edata, n_additional_fitparams)
+    results[:, offset:offset + fitresults.shape[1]] = fitresults
 
     print("done", index)
 
@@ -437,17 +467,11 @@ def individual_extr_at_relflow(index, args, samples, edatas, nt_finest, Nts):
     valid_tauT_indices = valid_tauT_indices & [*[False for _ in range(int(nt_finest_half / 2) - 1)], *[True for _ in range(int(nt_finest_half / 2) + 1)]]
     offset = count_falses_from_start(valid_tauT_indices)
 
-    for j in range(offset, nt_finest_half):
-
-        for m in range(args.nsamples):
-            ydata = [conftype_samples[index][m, j] for conftype_samples in samples]
-            edata = [conftype_edata[index, j] for conftype_edata in edatas]
-
-            fitparams = fit_sample(ydata, xdata, edata)
-
-            results[m][j] = fitparams[0]
-            results[m][j + nt_finest_half] = fitparams[1]
-            results[m][j + int(2 * nt_finest_half)] = fitparams[2]
+    # all samples and tauTs at once
+    ydata = numpy.moveaxis(samples[:, index, :args.nsamples, offset:nt_finest_half], 0, -1)  # (sample, tauT, conftype)
+    edata = edatas[:, index, offset:nt_finest_half].T
+    for i, fitparams in enumerate(fit_linear(ydata, xdata, edata)):
+        results[:, i * nt_finest_half + offset:(i + 1) * nt_finest_half] = fitparams
 
     print("done", index)
 
@@ -334,34 +334,36 @@ def combined_fit_ansatz(x, tauT, cont, base_slope):
     return cont + (base_slope)*x
 
 
-def combined_chisqdof(fitparams, ydata, xdata, edata, tauTs):
-    ndata = ydata.size
-    ntauT = ydata.shape[0]
-    chisq = 0
+def combined_fit_slope(tauT, base_slope):
+    """ slope of combined_fit_ansatz and its derivatives with respect to the slope parameters """
+    slope = base_slope + 0 * tauT
+    return slope, [numpy.ones_like(slope)]
 
-    combined_fitparams = fitparams[ntauT:]
 
-    for i in range(ntauT):
-        chisq += numpy.nansum(((combined_fit_ansatz(xdata, tauTs[i], fitparams[i], *combined_fitparams) - ydata[i])/edata[i]) ** 2)
-
-    nfitparams = len(fitparams)
-    chisqdof = chisq / (ndata-nfitparams)
-    return chisqdof
+def perform_combined_fit(ydata, xdata, tauTs, edata, nparams):
+    """ combined fit of all samples at once. ydata has the shape (nsamples, len(tauTs), len(xdata)), edata the shape (len(tauTs), len(xdata)).
+    returns the continuum values at all tauTs, the nparams slope parameters and chisq/dof for each sample. """
+    ntauT = len(tauTs)
+    nsamples = ydata.shape[0]
+    identity = numpy.broadcast_to(numpy.eye(ntauT)[None, :, None, :], (nsamples, ntauT, len(xdata), ntauT))
 
+    def model(fitparams):
+        slope, _ = combined_fit_slope(tauTs, *[fitparams[:, [ntauT + k]] for k in range(nparams)])
+        return (fitparams[:, :ntauT, None] + slope[:, :, None] * xdata[None, None, :]).reshape(len(fitparams), -1)
 
-def perform_combined_fit(ydata, xdata, tauTs, edata, nparams):
-    # fitparams = scipy.optimize.minimize(chisq, x0=numpy.asarray([0, 3]), bounds=(args.slope_bounds, (None, None)), args=[xdata, ydata, edata, None])
-    # fitparams = fitparams.x
-    #
-    # results[n] = fitparams
+    def jacobian(fitparams):
+        _, derivatives = combined_fit_slope(tauTs, *[fitparams[:, [ntauT + k]] for k in range(nparams)])
+        derivatives = [derivative[:, :, None, None] * xdata[None, None, :, None] for derivative in derivatives]
+        return numpy.concatenate([identity[:len(fitparams)], *derivatives], axis=-1).reshape(len(fitparams), ntauT * len(xdata), ntauT + nparams)
 
-    ntauT = len(tauTs)
-    # print(xdata, ydata, edata)
-    fitparams = scipy.optimize.minimize(combined_chisqdof, x0=numpy.asarray([*[1 for _ in range(ntauT)], *[1 for _ in range(nparams)]]),
-                                        bounds=([*[(0, 20) for _ in range(ntauT)], (None, 0), *[(None, None) for _ in range(nparams-2)]]), args=(ydata, xdata, edata, tauTs))
-    fitparams = fitparams.x
-    chisqdof = combined_chisqdof(fitparams, ydata, xdata, edata, tauTs)
-    return [*fitparams, chisqdof]
+    lower = [*[0 for _ in range(ntauT)], -numpy.inf, *[-numpy.inf for _ in range(nparams-1)]]
+    upper = [*[20 for _ in range(ntauT)], 0, *[numpy.inf for _ in range(nparams-1)]]
+    fitparams, chisq, success = lpd.bounded_least_squares(model, jacobian, ydata.reshape(nsamples, -1), edata.reshape(-1),
+                                                          numpy.ones(ntauT + nparams), lower, upper)
+    if not numpy.all(success):
+        print("WARN: the combined fit of", numpy.count_nonzero(~success), "of", nsamples, "samples did not converge")
+    chisqdof = chisq / (ydata[0].size - (ntauT + nparams))
+    return numpy.column_stack((fitparams, chisqdof))
 
 
 def count_falses_from_start(arr):
@@ -395,19 +397,13 @@ def combined_extrapolation(args, ntauT, finest_tauTs, cont_samples, data_std, n_
         mask = numpy.isnan(edata).any(axis=1)  # this should have shape tauT
         edata = edata[~mask]
         offset = count_falses_from_start(~mask)
-        for n in range(args.n_samples):
-            ydatatmp = []
-            for t in range(ntauT):
-                ydatatmp.append(cont_samples[n][t][indices])
-            ydata = numpy.asarray(ydatatmp)[~mask]  # ydata has now length of valid tauTs, and contains three flow points. same as edata should have
-
-            if len(xdata) >= 3:  # minimum amount for linear fit
-                fitresults = perform_combined_fit(ydata, xdata, finest_tauTs[~mask], edata, n_additional_fitparams)
-                for i, val in enumerate(fitresults):
-                    results[n][offset + i] = val
-            if n % 100 == 0:
-                print("\rfinished sample", n, end='', flush=True)
-        print("")
+        n_fit = n_samples if args.n_samples is None else min(args.n_samples, n_samples)
+        # ydata has the valid tauTs and the three flow points for each sample, same as edata
+        ydata = cont_samples[:n_fit][:, ~mask][:, :, indices]
+
+        if len(xdata) >= 3:  # minimum amount for linear fit
+            fitresults = perform_combined_fit(ydata, xdata, finest_tauTs[~mask], edata, n_additional_fitparams)
+            results[:n_fit, offset:offset + fitresults.shape[1]] = fitresults
 
     return results, indices
 
@@ -12,7 +12,7 @@ flowradiusbasepath=$5
 if [ -z "$qcdtype" ] || [ -z "$corr" ] || [ -z "$basepath_raw_data" ] || [ -z "$basepath_work_data" ] ; then
     echo "Usage: $0 qcdtype corr input_basepath output_basepath [flowradiusbasepath]"
     echo "choices for qcdtype: quenched_1.50Tc_zeuthenFlow hisq_ms5_zeuthenFlow"
-    echo "choices for corr: EE BB EE_clover BB_clover"
+    echo "choices for corr: EE BB EE_clover BB_clover, or all (only for hisq_ms5_zeuthenFlow)"
     echo "Usage example: $0 hisq_ms5_zeuthenFlow EE /work/data/altenkort/gradientFlow ../../../../data/merged/ /home/altenkort/work/correlators_flow/data/merged/hisq_ms5_zeuthenFlow/EE/"
     exit
 fi
@@ -21,13 +21,17 @@ fi
 if [ "$qcdtype" == quenched_1.50Tc_zeuthenFlow ] ; then
     arr_conftypes=("s064t16_b0687361" "s080t20_b0703500" "s096t24_b0719200" "s120t30_b0739400" "s144t36_b0754400")
 
-    # here we need to adjust the file names via --acc_sts due to historical reasons
+    # here we need to adjust the file names via --acc_sts due to historical reasons. these differ between EE and BB, so they can't be merged
+    # in one call with --corr all.
     if [ "$corr" == "EE" ] ; then
         acc_sts="--acc_sts acc0.000010_sts0.000010"
         add_args="--legacy --basepath ../../../../data/raw/"
     elif [ "$corr" == "BB" ] ; then
         acc_sts="--acc_sts sts0.150000"
         add_args="--basepath ../../../../data/raw/"
+    else
+        echo "ERROR: only EE and BB are available for $qcdtype"
+        exit 1
     fi
 
 elif [ "$qcdtype" == hisq_ms5_zeuthenFlow ] ; then
@@ -9,7 +9,7 @@ nproc=${5:-"20"}
 if [ -z "$qcdtype" ] || [ -z "$corr" ] || [ -z "$basepath_work_data" ] || [ -z "$basepath_plot" ] ; then
     echo "Usage: $0 qcdtype corr basepath_work_data basepath_plot [nproc]"
     echo "choices for qcdtype: quenched_1.50Tc_zeuthenFlow hisq_ms5_zeuthenFlow"
-    echo "choices for corr: EE BB EE_clover BB_clover"
+    echo "choices for corr: EE BB EE_clover BB_clover, or all (every correlator that was merged for the conftype)"
     echo "Example: $0 hisq_ms5_zeuthenFlow EE ../../../../data/merged/ ../../../../plots/"
     exit
 fi
@@ -51,10 +51,7 @@ def plot_single_flowtime(index, flowradii, args, tauT, XX, XX_err, labels, ylims
 
 
 def apply_tree_level_imp(XX,nt, flowtimes, corr, flowaction, gaugeaction):
-    for i in range(XX.shape[0]):
-        flowtime = flowtimes[i]
-        for j in range(XX.shape[1]):
-            XX[i, j] = XX[i, j] / lpd.G_latt_LO_flow(j, flowtime, corr, nt, flowaction, gaugeaction) * nt**4
+    XX[:] = XX * lpd.get_tree_level_normalization(flowtimes, corr, nt, flowaction, gaugeaction)[:XX.shape[0], :XX.shape[1]]
     return XX
 
 
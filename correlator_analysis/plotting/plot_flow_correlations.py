@@ -19,8 +19,8 @@ def compute_XX_corr(data):
     return XX
 
 
-def plot_correlation_matrix(index, data, flow_radii, nt):
-    data = data[index]
+def plot_correlation_matrix(index, correlation, flow_radii, nt):
+    data = numpy.copy(correlation[index])
 
     tauT = (index + 1) / nt
     label = '{0:.2f}'.format(tauT)
@@ -28,8 +28,6 @@ def plot_correlation_matrix(index, data, flow_radii, nt):
     title = r'\begin{center}$\mathrm{corr}[G_E(\tau_\mathrm{F}), G_E(\tau_\mathrm{F}\prime)]$ \\ $\tau T ='
     title = title + label + r'$ \end{center}'
 
-    data = numpy.corrcoef(data)
-
     xydata = flow_radii/tauT
     for i in range(len(xydata)):
         for j in range(len(xydata)):
@@ -98,14 +96,14 @@ def main():
 
     # data = numpy.concatenate((EE_numerator, polyakov_real), axis=2)
 
-    XX_samples = numpy.load(lpd.get_merged_data_path(args.qcdtype, args.corr, args.conftype, args.basepath) + args.corr + "_" + args.conftype + "_samples.npy")
-    print(XX_samples.shape)
+    # the flow correlation matrix of each tau is computed from the bootstrap samples in _2_reduce_data.py
+    _, correlation = lpd.load_flow_covariance(lpd.get_merged_data_path(args.qcdtype, args.corr, args.conftype, args.basepath) + args.corr + "_flow_cov_" + args.conftype + ".npz")
+    print(correlation.shape)
 
     # XX_samples, _, _ = bootstr.bootstr(est.compute_XX_corr, data, numb_samples=10000, sample_size=n_datafiles, conf_axis=0, return_sample=True,
     #                                          same_rand_for_obs=True, parallelize=True, nproc=args.nproc, seed=0, err_by_dist=True)
 
     # XX_samples = numpy.asarray(XX_samples)
-    XX_samples = numpy.swapaxes(XX_samples, 0, 2)
 
     # bring data in correct shape for numpy.cov
     # polyakov_real = numpy.copy(polyakov_real[:, :, 0])
@@ -113,7 +111,7 @@ def main():
     # print(polyakov_real.shape)
     # plot_correlation_matrix(polyakov_real, flow_radii, r'$\mathrm{corr}[X(\tau_\mathrm{F}), X(\tau_\mathrm{F}\prime)], X= U(\beta, 0) $', "poly")
 
-    figs = lpd.parallel_function_eval(plot_correlation_matrix, range(nt_half), args.nproc, XX_samples, flow_radii, nt)
+    figs = lpd.parallel_function_eval(plot_correlation_matrix, range(nt_half), args.nproc, correlation, flow_radii, nt)
     # data = numpy.copy(EE_numerator[:, :, i])
     # data = numpy.swapaxes(data, 0, 1)
     # plot_correlation_matrix(data, flow_radii/tauT, r'$\mathrm{corr}[X(\tau_\mathrm{F}), X(\tau_\mathrm{F}\prime)], \newline X= U(\beta, \tau) E(\tau) U(\tau, 0) E(0), \tau T ='+label+r'$', args.outputfolder+"EE_tauT"+label)
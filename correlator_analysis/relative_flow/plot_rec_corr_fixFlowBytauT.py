@@ -105,10 +105,10 @@ def plot_relative_flow(args, ax, plot_offset):
             # interpolate between flow times
             y_int = []
             e_int = []
+            norm = lpd.get_tree_level_normalization(these_flowtimes, corr, nt, flowaction, gaugeaction)
             for i in range(len(these_tauT)):
-                G_latt_LO_flow = lpd.G_latt_LO_flow(i, these_flowtimes, corr, nt, flowaction, gaugeaction)
-                ydata = numpy.asarray(XX[:, i]) * nt ** 4 / G_latt_LO_flow
-                edata = numpy.asarray(XX_err[:, i]) * nt ** 4 / numpy.fabs(G_latt_LO_flow)
+                ydata = numpy.asarray(XX[:, i]) * norm[:, i]
+                edata = numpy.asarray(XX_err[:, i]) * numpy.fabs(norm[:, i])
                 xdata = these_flowradii
                 min_index = numpy.fabs(these_flowradii-args.min_flowradius).argmin()-1
                 y_int.append(scipy.interpolate.InterpolatedUnivariateSpline(xdata[min_index:], ydata[min_index:], k=3, ext=2, check_finite=True))
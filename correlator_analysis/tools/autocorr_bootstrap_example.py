@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import numpy
+import argparse
 import scipy.signal
 from latqcdtools.statistics import statistics as stat
 from latqcdtools.statistics import bootstr
@@ -17,25 +18,45 @@ def formatfloat(number):
     return '{0:.5f}'.format(number)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--merged_file', type=str, default=None,
+                        help="instead of a synthetic time series, use the polyakov loop of the first stream in this merged data container "
+                             "(<corr>_<conftype>_merged.bin, see _1_merge_data.py)")
+    parser.add_argument('--flowradius_T', default=0.15, type=float, help="flow radius in units of 1/T at which the polyakov loop is taken")
+    args = parser.parse_args()
+    return args
+
+
 def main():
 
-    n = 100000
-    x = range(n)
+    args = parse_args()
 
     mean = 0
     stddev = 1
-    stderr = stddev/numpy.sqrt(n)
-    noise = numpy.random.normal(mean, stddev, n)
     truetauint = 100
-    kernel = [1/truetauint for _ in range(truetauint)]  # [1, 1, 1, 1, 1 .... 1]
-    conv = scipy.signal.fftconvolve(noise, kernel, mode='valid')
+    if args.merged_file is None:
+        n = 100000
+        stderr = stddev/numpy.sqrt(n)
+        noise = numpy.random.normal(mean, stddev, n)
+        kernel = [1/truetauint for _ in range(truetauint)]  # [1, 1, 1, 1, 1 .... 1]
+        conv = scipy.signal.fftconvolve(noise, kernel, mode='valid')
+    else:
+        # only the requested flow time of the first stream is read from disk
+        attrs, merged = lpd.load_merged_container(args.merged_file)
+        _, _, nt, _ = lpd.parse_conftype(attrs['conftype'])
+        flowidx = numpy.argmin(numpy.abs(numpy.sqrt(8*numpy.asarray(merged['flow_times']))/nt - args.flowradius_T))
+        conv = numpy.asarray(merged['polyakov_real'][flowidx, :attrs['n_files_per_stream'][0]])
+    x = range(len(conv))
 
     fig, ax, plots = lpd.create_figure()
 
-    tpickmax = 1000
+    tpickmax = min(1000, int(len(conv)/4))
     nblocks = int(len(conv)/tpickmax)
     tau_int, tau_inte, tau_intbias, itpick = stat.getTauInt(conv, nblocks, tpickmax, acoutfileName='acor.d', showPlot=False)
     print("tau_int=", formatfloat(tau_int), "+-", formatfloat(tau_inte), "(+", formatfloat(tau_intbias), "), itpick=", itpick, sep="")
+    if args.merged_file is not None:
+        truetauint = max(1, int(tau_int))
 
     nplot = 1000
     ax.plot(x[:nplot], conv[:nplot]/len(conv), label="correlated signal")
@@ -48,7 +69,8 @@ def main():
 
     blockeddata = numpy.asarray(blockeddata)
 
-    print("true values:                                       ", formatfloat(mean), formatfloat(stderr))
+    if args.merged_file is None:
+        print("true values:                                       ", formatfloat(mean), formatfloat(stderr))
     # print("direct calculation (mean and std error):           ", formatfloat(numpy.mean(noise)), formatfloat(numpy.std(noise, ddof=1) / numpy.sqrt(numpy.size(noise))))
     print("direct calculation (mean and std error):           ", formatfloat(numpy.mean(conv)),
           formatfloat(numpy.std(conv, ddof=1) / numpy.sqrt(numpy.size(conv))))
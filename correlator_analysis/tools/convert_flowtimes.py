@@ -15,6 +15,9 @@ def main():
     parser.add_argument('--output_a', type=float, help="lattice spacing of output lattice")
     parser.add_argument('--threshold', default=0.3, type=float, help="maximum flow RADIUS in units of temperature")
     parser.add_argument('--type', choices=["fixed_temperature", "different_temperature"])
+    parser.add_argument('--snap_to', type=str,
+                        help="path to a file with lattice flow times that already exist for the output lattice. converted flow times that agree with one "
+                             "of them (within the tolerance of numpy.isclose) are replaced by it, such that they can later be matched exactly.")
     args = parser.parse_args()
 
     if args.type == "fixed_temperature":
@@ -29,18 +32,23 @@ def main():
             print("WARN: input_a should be smaller than output_a, to ensure that stepsizes do not increase.")
 
     flowtimes_input = numpy.loadtxt(args.input)
-    flowtimes_output = []
-    one_more = True
-    for tf in flowtimes_input:
-        if args.type == "fixed_temperature":
-            tf_prime = tf/args.input_Nt**2 * args.output_Nt**2
-        elif args.type == "different_temperature":
-            tf_prime = tf * args.input_a ** 2 / args.output_a ** 2
-        if numpy.sqrt(8*tf_prime)/args.output_Nt <= args.threshold:
-            flowtimes_output.append(tf_prime)
-        elif one_more:
-            flowtimes_output.append(tf_prime)
-            one_more = False
+    if args.type == "fixed_temperature":
+        flowtimes_output = flowtimes_input/args.input_Nt**2 * args.output_Nt**2
+    elif args.type == "different_temperature":
+        flowtimes_output = flowtimes_input * args.input_a ** 2 / args.output_a ** 2
+
+    # keep all flow times below the threshold and one more
+    mask = numpy.sqrt(8*flowtimes_output)/args.output_Nt <= args.threshold
+    above = numpy.flatnonzero(~mask)
+    if len(above) > 0:
+        mask[above[0]] = True
+    flowtimes_output = flowtimes_output[mask]
+
+    if args.snap_to:
+        reference = lpd.FloatGrid(numpy.loadtxt(args.snap_to))
+        matches = reference.match(flowtimes_output)
+        flowtimes_output = numpy.where(matches >= 0, reference.grid[matches], flowtimes_output)
+        print("INFO:", numpy.count_nonzero(matches >= 0), "of", len(flowtimes_output), "flow times already exist in", args.snap_to)
 
     print(numpy.asarray(flowtimes_output))
     numpy.savetxt("flowtimes_"+args.output+"_Nt"+str(int(args.output_Nt))+".txt", flowtimes_output, fmt='%.9f', newline=' ')
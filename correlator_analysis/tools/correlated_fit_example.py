@@ -42,21 +42,16 @@ def get_data_corrmatrix(indices, tau_index):
     y = np.nanmedian(XX_samples, axis=0)
     e = lpd.dev_by_dist(XX_samples, axis=0)
 
-    tmpcov = np.cov(XX_samples, rowvar=False)
-    tmpcorr = np.corrcoef(XX_samples, rowvar=False)
-
     # filter out data points outside of extr window
     x = x[indices]
     y = y[indices]
     e = e[indices]
 
-    ndata = len(x)
-    data_cov = np.empty((ndata, ndata))
-    data_corr = np.empty((ndata, ndata))
-    for i in range(ndata):
-        for j in range(ndata):
-            data_cov[i, j] = tmpcov[indices[i], indices[j]]
-            data_corr[i, j] = tmpcorr[indices[i], indices[j]]
+    # covariance and correlation of the flow times in one pass over the samples
+    flow_covariance = lpd.CovarianceAccumulator()
+    flow_covariance.add(XX_samples[:, indices])
+    data_cov = flow_covariance.covariance()
+    data_corr = flow_covariance.correlation()
 
     print("data correlation matrix:\n", data_corr)
 
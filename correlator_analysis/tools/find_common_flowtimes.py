@@ -4,10 +4,6 @@ import numpy
 import argparse
 
 
-def float_intersection(a, b):
-    return b[numpy.isclose(a[:, None], b).any(0)]
-
-
 def main():
 
     parser = argparse.ArgumentParser()
@@ -23,11 +19,8 @@ def main():
         tmp = numpy.loadtxt(args.basepath+file)
         flowtimes.append(tmp)
 
-    intersection = flowtimes[0]
-    print(intersection.shape)
-    for i in range(1, len(flowtimes)):
-        intersection = float_intersection(flowtimes[i], intersection)
-        print(intersection.shape)
+    intersection = lpd.common_grid(*flowtimes)
+    print([len(tmp) for tmp in flowtimes], "->", intersection.shape)
 
     numpy.savetxt(args.output, intersection)
     return
@@ -102,15 +102,22 @@ export NPROC=1
 export tmppath="./correlators_flow/correlator_analysis/double_extrapolation/example_usage"
 ./$tmppath/1_merge_data.sh hisq_ms5_zeuthenFlow EE $BASEPATH_RAW_DATA $BASEPATH_WORK_DATA $BASEPATH_RAW_DATA/hisq_ms5_zeuthenFlow/reference_flowtimes
 
+# The merge can also read the raw data directly from the archive, without extracting the correlator files to disk, by passing
+# $(pwd)/input_data.tar.gz instead of $BASEPATH_RAW_DATA as the third argument (the reference flow times and pertLO files are still needed
+# as extracted files). Archives created with "tar --sort=name" can be read with the least memory.
+
 # Afterwards, the following files have been created inside
 # $BASEPATH_WORK_DATA/hisq_ms5_zeuthenFlow/EE/<conftype>/
 
 # flowtimes_<conftype>.dat              | flowtimes that were measured, corresponding to the data inside the .npy files
 # n_datafiles_<conftype>.dat            | metadata (number of files per stream, MCMC trajectory number, etc.)
-# EE_imag_<conftype>_merged.npy         | merged raw data, imaginary part of EE correlator
-# EE_real_<conftype>_merged.npy         | merged raw data, real part of EE correlator
-# polyakov_imag_<conftype>_merged.npy   | merged raw data, imaginary part of polyakovloop
-# polyakov_real_<conftype>_merged.npy   | merged raw data, real part of polyakovloop
+# manifest_<conftype>.dat               | stream, conf number, size and mtime of every ingested file (used by --incremental)
+# EE_<conftype>_merged.bin              | merged raw data (real and imaginary parts of EE correlator and polyakovloop, flow times, conf numbers and
+#                                       | streams) in one binary container, see lib_process_data.load_merged_container
+
+# Instead of EE, "all" can be passed as corr to merge all correlators (EE, BB, EE_clover, BB_clover) that are found in one pass over the raw
+# data. Then the polyakovloop is only stored once in $BASEPATH_WORK_DATA/hisq_ms5_zeuthenFlow/polyakov/<conftype>/polyakov_<conftype>_merged.bin
+# and only confs for which the data of all correlators is fine are merged.
 
 # where <conftype> may be, for example,
 # s096t36_b0824900_m002022_m01011 (meaning Ns=96, Nt=36, beta=8.249, m_l=0.002022, m_s=0.01011). m_l and m_s are optional.
@@ -121,13 +128,15 @@ export tmppath="./correlators_flow/correlator_analysis/double_extrapolation/exam
 #
 # Load the merged data files, extract an equally spaced MCMC time series, then plot the time history of the Polyakov loop at a large flow time.
 # Then bin configurations according to the integrated autocorrelation time, then perform bootstrap resampling of the uncorrelated blocks and save the samples to numpy files (binary format).
+# If the correlators were merged with --corr all, _2_reduce_data.py --corr all bins all of them with one common binning and resamples them
+# with the same bootstrap samples, so that e.g. EE/BB ratios can be computed sample by sample. The Polyakov loop plot then goes to .../polyakov/<conftype>/.
 ./$tmppath/2_reduce_data.sh hisq_ms5_zeuthenFlow EE $BASEPATH_WORK_DATA $BASEPATH_PLOT $NPROC
 
 # Afterwards, the following files have been created inside
 # $BASEPATH_WORK_DATA/hisq_ms5_zeuthenFlow/EE/<conftype>/
 
 # EE_<conftype>_samples.npy   | bootstrap samples of EE correlator
-# EE_flow_cov_<conftype>.npy  | flow time correlation matrix (based on bootstrap samples)
+# EE_flow_cov_<conftype>.npz  | flow time covariance and correlation matrix for each tau (based on bootstrap samples, load with lpd.load_flow_covariance)
 # EE_<conftype>.dat           | median EE correlator (useful for checking the data / plotting)
 # EE_err_<conftype>.dat       | std_dev of EE correlator (useful for checking the data / plotting)
 
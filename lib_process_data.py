@@ -8,7 +8,10 @@ from matplotlib.ticker import AutoMinorLocator
 import sys
 import scipy.interpolate
 import concurrent.futures
+import itertools
 import os
+import json
+import hashlib
 
 
 def format_float(number, digits=3):
@@ -98,11 +101,15 @@ def parse_qcdtype(qcdtype):
 
 
 # === read and parse cmd line arguments ===
-def get_parser():
+def get_parser(allow_all_corrs=False, all_corrs_help="process every correlator that is found at once"):
     parser = argparse.ArgumentParser()
     requiredNamed = parser.add_argument_group('required named arguments')
     requiredNamed.add_argument('--qcdtype', help="format doesnt matter, only used for finding data. example: quenched_1.50Tc_zeuthenFlow", required=True)
-    requiredNamed.add_argument('--corr', choices=['EE', 'EE_clover', 'BB', 'BB_clover'], help="choose from EE, EE_clover, BB, BB_clover", required=True)
+    if allow_all_corrs:
+        requiredNamed.add_argument('--corr', choices=['EE', 'EE_clover', 'BB', 'BB_clover', 'all'], required=True,
+                                   help="choose from EE, EE_clover, BB, BB_clover, or all to " + all_corrs_help)
+    else:
+        requiredNamed.add_argument('--corr', choices=['EE', 'EE_clover', 'BB', 'BB_clover'], help="choose from EE, EE_clover, BB, BB_clover", required=True)
     return parser, requiredNamed
 
 
@@ -110,6 +117,10 @@ def get_merged_data_path(qcdtype, corr, conftype, basepath="../../data/merged/")
     return basepath + "/" + qcdtype + "/" + corr + "/" + conftype + "/"
 
 
+def get_merged_container_path(qcdtype, corr, conftype, basepath="../../data/merged/"):
+    return get_merged_data_path(qcdtype, corr, conftype, basepath) + corr + "_" + conftype + "_merged.bin"
+
+
 def get_raw_data_path(qcdtype, conftype, basepath="../../data/raw/"):
     return basepath + "/" + qcdtype + "/" + conftype + "/"
 
@@ -134,11 +145,256 @@ def write_flow_times(outfile, flow_times):
     outfile.write('\n')
 
 
+# === binary container that holds several arrays which can be memory-mapped independently ===
+# file layout: magic | uint64 size of reserved header space | uint64 size of json header | json header | arrays (each aligned to container_alignment)
+# the json header contains the offset, shape and dtype of each array as well as a dict of user attributes.
+
+container_magic = b'CFLOWCTR'
+container_alignment = 4096
+
+
+def _round_up(number, multiple):
+    return -(-number // multiple) * multiple
+
+
+def _to_json(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("cannot serialize " + str(type(obj)))
+
+
+def _write_container_header(filename, layout, attrs, header_reserve):
+    header = json.dumps(dict(arrays=layout, attrs=attrs), default=_to_json).encode()
+    if len(header) > header_reserve:
+        print("ERROR: container header of", filename, "does not fit into the reserved space (", len(header), ">", header_reserve, "bytes)")
+        exit(1)
+    with open(filename, 'r+b') as outfile:
+        outfile.write(container_magic)
+        outfile.write(numpy.asarray([header_reserve, len(header)], dtype='<u8').tobytes())
+        outfile.write(header)
+
+
+def _read_container_header(filename):
+    with open(filename, 'rb') as infile:
+        if infile.read(len(container_magic)) != container_magic:
+            print("ERROR:", filename, "is not a container file")
+            exit(1)
+        header_reserve, header_length = numpy.frombuffer(infile.read(16), dtype='<u8')
+        header = json.loads(infile.read(int(header_length)).decode())
+    return header['arrays'], header['attrs'], int(header_reserve)
+
+
+def _map_container_arrays(filename, layout, mode):
+    arrays = {}
+    for name, entry in layout.items():
+        shape = tuple(entry['shape'])
+        if numpy.prod(shape) == 0:
+            arrays[name] = numpy.empty(shape, dtype=entry['dtype'])
+        else:
+            arrays[name] = numpy.memmap(filename, dtype=entry['dtype'], mode=mode, offset=entry['offset'], shape=shape)
+    return arrays
+
+
+def create_container(filename, arrays, attrs=None, header_reserve=65536):
+    """ create a container file. arrays is a dict that maps names to (shape, dtype). returns a dict that maps the names to writable memory maps
+    of the (zero-initialized) arrays. attrs is a json-serializable dict that can be changed later with update_container_attrs. """
+    attrs = {} if attrs is None else attrs
+    offset = _round_up(len(container_magic) + 16 + header_reserve, container_alignment)
+    layout = {}
+    for name, (shape, dtype) in arrays.items():
+        dtype = numpy.dtype(dtype)
+        shape = [int(n) for n in numpy.atleast_1d(shape)]
+        layout[name] = dict(offset=offset, shape=shape, dtype=dtype.str)
+        offset = _round_up(offset + int(numpy.prod(shape)) * dtype.itemsize, container_alignment)
+    with open(filename, 'wb') as outfile:
+        outfile.truncate(offset)
+    _write_container_header(filename, layout, attrs, header_reserve)
+    return _map_container_arrays(filename, layout, 'r+')
+
+
+def update_container_attrs(filename, attrs):
+    layout, _, header_reserve = _read_container_header(filename)
+    _write_container_header(filename, layout, attrs, header_reserve)
+
+
+def open_container(filename, mode='r'):
+    """ returns the attrs and a dict of memory maps of all arrays of a container file. nothing is read from disk until the arrays are accessed. """
+    layout, attrs, _ = _read_container_header(filename)
+    return attrs, _map_container_arrays(filename, layout, mode)
+
+
+def load_merged_container(filename):
+    """ open a container written by _1_merge_data.py. the conf axis of each array (given by attrs['conf_axis']) is trimmed to the number of confs
+    that were actually written. observables are stored flow-time-major, i.e. (nflow, nconf, ...), such that a flow time slice or a stream (which is a
+    contiguous range of confs) can be accessed without reading the rest.
+    if several correlators were merged at once, the polyakov loop is stored in a separate container that is shared by all of them and that is
+    referenced in attrs['polyakov_container']. its arrays are added transparently. """
+    attrs, arrays = open_container(filename)
+    if 'polyakov_container' in attrs:
+        polyakov_path = os.path.join(os.path.dirname(filename), attrs['polyakov_container'])
+        polyakov_attrs, polyakov_arrays = open_container(polyakov_path)
+        nconf = attrs['nconf']
+        if polyakov_attrs['nconf'] != nconf or polyakov_attrs['streamids'] != attrs['streamids'] \
+                or polyakov_attrs['n_files_per_stream'] != attrs['n_files_per_stream'] \
+                or not numpy.array_equal(polyakov_arrays['conf_nums'][:nconf], arrays['conf_nums'][:nconf]):
+            print("ERROR: the confs of", polyakov_path, "do not match the ones of", filename, ". merge all correlators again.")
+            exit(1)
+        for name in ("polyakov_real", "polyakov_imag"):
+            arrays[name] = polyakov_arrays[name]
+            attrs['conf_axis'][name] = polyakov_attrs['conf_axis'][name]
+    for name, axis in attrs['conf_axis'].items():
+        arrays[name] = arrays[name][(slice(None),) * axis + (slice(0, attrs['nconf']),)]
+    return attrs, arrays
+
+
+# === alignment of flow times (or any other set of floats) ===
+
+class FloatGrid:
+    """ sorted index of a reference grid of floats, e.g. flow times or flow radii. values are matched to the closest grid point with searchsorted,
+    using the same tolerance as numpy.isclose(value, grid point), instead of comparing every value to every grid point. """
+    def __init__(self, grid, rtol=1e-05, atol=1e-08):
+        self.grid = numpy.asarray(grid, dtype=float).ravel()
+        self.rtol = rtol
+        self.atol = atol
+        self._order = numpy.argsort(self.grid, kind='stable')
+        self._sorted = self.grid[self._order]
+
+    def __len__(self):
+        return len(self.grid)
+
+    def match(self, values):
+        """ returns the index (into grid) of the closest grid point of each value, or -1 if no grid point is close enough """
+        values = numpy.asarray(values, dtype=float)
+        if len(self.grid) == 0:
+            return numpy.full(values.shape, -1)
+        right = numpy.clip(numpy.searchsorted(self._sorted, values), 0, len(self.grid)-1)
+        left = numpy.clip(right-1, 0, len(self.grid)-1)
+        closest = numpy.where(numpy.abs(self._sorted[right] - values) < numpy.abs(self._sorted[left] - values), right, left)
+        close = numpy.abs(values - self._sorted[closest]) <= self.atol + self.rtol * numpy.abs(self._sorted[closest])
+        return numpy.where(close, self._order[closest], -1)
+
+    def contains(self, values):
+        """ boolean mask of the values that are on the grid """
+        return self.match(values) >= 0
+
+    def indices_of(self, values):
+        """ indices of the values that are on the grid, in the order of the values """
+        return numpy.flatnonzero(self.contains(values))
+
+
+def common_grid(*grids, rtol=1e-05, atol=1e-08):
+    """ the values of the first grid that are (within the tolerance) contained in all other grids, e.g. the flow times that all ensembles have in
+    common. """
+    common = numpy.asarray(grids[0], dtype=float)
+    for grid in grids[1:]:
+        common = common[FloatGrid(grid, rtol, atol).contains(common)]
+    return common
+
+
 def chmap(mydict, **kwargs):
     c = ChainMap(kwargs, mydict)
     return c
 
 
+# === interpolation of many samples at once ===
+
+_spline_operator_storage = {}
+
+
+def cubic_spline_operator(xdata, output_xdata, bc_type=((2, 0.0), (2, 0.0)), extrapolate=None):
+    """ matrix S of shape (len(output_xdata), len(xdata)) such that S @ ydata equals CubicSpline(xdata, ydata, bc_type=bc_type,
+    extrapolate=extrapolate)(output_xdata) for any ydata. this works because the spline is linear in ydata if all boundary derivatives are 0 (only
+    these are supported), so many samples on the same nodes can be interpolated with one matrix product, e.g. samples @ S.T.
+    the operators are cached. """
+    xdata, output_xdata = numpy.asarray(xdata, dtype=float), numpy.asarray(output_xdata, dtype=float)
+    identifier = (xdata.tobytes(), output_xdata.tobytes(), str(bc_type), extrapolate)
+    if identifier not in _spline_operator_storage:
+        if not isinstance(bc_type, str):
+            # the derivative values need the shape of the (here: vector-valued) ydata
+            bc_type = tuple(bc if isinstance(bc, str) else (bc[0], numpy.full(len(xdata), bc[1])) for bc in bc_type)
+        spline = scipy.interpolate.CubicSpline(xdata, numpy.identity(len(xdata)), bc_type=bc_type, extrapolate=extrapolate)
+        _spline_operator_storage[identifier] = spline(output_xdata)
+    return _spline_operator_storage[identifier]
+
+
+# === least squares fits of many samples at once ===
+
+def bounded_least_squares(model, jacobian, ydata, edata, p0, lower=None, upper=None, warm_start=True, max_iter=200, tol=1e-12):
+    """ minimize chisq = sum(((model(p) - ydata) / edata)**2) for many independent data sets (e.g. bootstrap samples) at once with a
+    Levenberg-Marquardt method with box constraints: steps are projected onto the bounds and parameters at an active bound are kept fixed.
+    model(p) returns the model of shape (nsets, ndata) for parameters p of shape (nsets, nparams), jacobian(p) its derivatives with respect to the
+    parameters, of shape (nsets, ndata, nparams). ydata has the shape (nsets, ndata), edata is broadcastable to it. nan entries are ignored.
+    p0: start parameters of shape (nparams,) or (nsets, nparams). lower/upper: bounds of shape (nparams,), use -inf/inf for none.
+    if warm_start, the median of ydata is fitted first (starting from p0) and its result is used as the start for all data sets.
+    returns the parameters (nsets, nparams), chisq (nsets) and whether the fit of each set converged (nsets). the fits that did not converge within
+    max_iter iterations, or got stuck (no decrease of chisq even for very strong damping), are returned as they are. """
+    ydata = numpy.asarray(ydata, dtype=float)
+    nsets = ydata.shape[0]
+    edata = numpy.broadcast_to(numpy.asarray(edata, dtype=float), ydata.shape)
+    p0 = numpy.asarray(p0, dtype=float)
+    nparams = p0.shape[-1]
+    lower = numpy.full(nparams, -numpy.inf) if lower is None else numpy.asarray(lower, dtype=float)
+    upper = numpy.full(nparams, numpy.inf) if upper is None else numpy.asarray(upper, dtype=float)
+
+    if warm_start and nsets > 1 and p0.ndim == 1:
+        median_params, _, _ = bounded_least_squares(model, jacobian, numpy.nanmedian(ydata, axis=0)[None], numpy.nanmedian(edata, axis=0)[None], p0,
+                                                 lower, upper, warm_start=False, max_iter=max_iter, tol=tol)
+        p0 = median_params[0]
+
+    mask = numpy.isnan(ydata) | numpy.isnan(edata)
+    weights = numpy.where(mask, 0, 1 / numpy.where(mask, 1, edata))
+    ydata = numpy.where(mask, 0, ydata)
+
+    params = numpy.clip(numpy.broadcast_to(p0, (nsets, nparams)), lower, upper)
+    residuals = (model(params) - ydata) * weights
+    chisq = numpy.sum(residuals ** 2, axis=-1)
+    damping = numpy.full(nsets, 1e-3)
+    scale = numpy.zeros((nsets, nparams))
+    running = numpy.isfinite(chisq)
+    success = numpy.zeros(nsets, dtype=bool)
+    identity = numpy.eye(nparams)
+
+    for _ in range(max_iter):
+        idx = numpy.flatnonzero(running)
+        if len(idx) == 0:
+            break
+        p = params[idx]
+        J = jacobian(p) * weights[idx, :, None]
+        gradient = numpy.einsum('ndp,nd->np', J, residuals[idx])
+        A = numpy.einsum('ndp,ndq->npq', J, J)
+
+        # damp with the largest diagonal so far of each parameter (like MINPACK), which keeps the system regular for parameters that
+        # (currently) barely change the model
+        scale[idx] = numpy.maximum(scale[idx], numpy.diagonal(A, axis1=1, axis2=2))
+        diagonal = numpy.maximum(scale[idx], numpy.maximum(1e-12 * numpy.max(scale[idx], axis=1, keepdims=True), 1e-30))
+        A = A + damping[idx, None, None] * diagonal[:, :, None] * identity
+
+        # parameters at a bound that the gradient points beyond are kept fixed
+        free = ~(((p <= lower) & (gradient > 0)) | ((p >= upper) & (gradient < 0)))
+        A = A * free[:, :, None] * free[:, None, :] + ~free[:, :, None] * identity
+        step = -numpy.linalg.solve(A, (gradient * free)[..., None])[..., 0]
+
+        p_new = numpy.clip(p + step, lower, upper)
+        residuals_new = (model(p_new) - ydata[idx]) * weights[idx]
+        chisq_new = numpy.sum(residuals_new ** 2, axis=-1)
+        improved = chisq_new < chisq[idx]
+
+        # converged if chisq or the parameters no longer change. at a minimum steps can also be rejected due to rounding, which is detected by the
+        # decrease of chisq that the (projected) gradient allows for at all, independent of the damping
+        predicted_decrease = numpy.sum((gradient * free) ** 2 / diagonal, axis=1)
+        converged = (improved & (chisq[idx] - chisq_new <= tol * chisq[idx])) | (~improved & (predicted_decrease <= tol * chisq[idx])) \
+            | ((damping[idx] <= 1) & numpy.all(numpy.abs(p_new - p) <= tol * (numpy.abs(p) + tol), axis=1))
+        success[idx[converged]] = True
+        converged |= damping[idx] > 1e10
+        params[idx[improved]] = p_new[improved]
+        residuals[idx[improved]] = residuals_new[improved]
+        chisq[idx[improved]] = chisq_new[improved]
+        damping[idx] = numpy.where(improved, damping[idx] / 10, damping[idx] * 10)
+        running[idx[converged]] = False
+
+    return params, chisq, success
+
+
 # === functions related to the EE correlator ===
 
 def get_tauTs(nt):
@@ -173,6 +429,88 @@ def EE_cont_LO(tauT, sqrt8tauF_T=0):
 
 
 G_latt_LO_flow_storage = {}
+G_latt_LO_norm_storage = {}
+
+
+_G_PERT_LO_DIR = None
+
+
+def get_pert_LO_dir():
+    """ directory of the perturbative LO tables. the environment variable G_PERT_LO_DIR is only read once. """
+    global _G_PERT_LO_DIR
+    if _G_PERT_LO_DIR is None:
+        _G_PERT_LO_DIR = os.environ.get('G_PERT_LO_DIR', "")
+        if not _G_PERT_LO_DIR:
+            # print("Warn: environment variable G_PERT_LO_DIR is not set, using default path")
+            _G_PERT_LO_DIR = "/work/home/altenkort/work/correlators_flow/data/merged/pert_LO/"
+    return _G_PERT_LO_DIR
+
+
+def _save_G_latt_LO_flow_spline(filename, flowtimes, spline, attrs):
+    # write to a file of this process first, such that concurrent processes never read a partially written file
+    tmp_filename = filename + "." + str(os.getpid()) + ".tmp"
+    arrays = create_container(tmp_filename, {'flowtimes': (flowtimes.shape, flowtimes.dtype), 'knots': (spline.t.shape, spline.t.dtype),
+                                             'coefficients': (spline.c.shape, spline.c.dtype)}, attrs, header_reserve=4096)
+    arrays['flowtimes'][:] = flowtimes
+    arrays['knots'][:] = spline.t
+    arrays['coefficients'][:] = spline.c
+    for array in arrays.values():
+        array.flush()
+    arrays = None
+    os.replace(tmp_filename, filename)
+
+
+def get_G_latt_LO_flow_spline(corr: str, Nt: int, flowaction: str, gaugeaction: str):
+    """ one spline in flow time (units of lattice spacing squared) of the perturbative LO correlator at all tau indices, i.e. a spline in flow time
+    whose values are arrays of length Nt/2.
+    the flow grid and the spline coefficients are stored in a container file next to the tabulated data (<corr>_pert_latt_..._spline.bin), which is
+    (re)created from the text files if it is missing or older than them. the spline then uses memory maps of this file, so that the table is neither
+    parsed nor fitted again and all processes share the same pages. once loaded it is stored in a global dictionary for future access. """
+
+    identifier = corr+str(Nt)+flowaction+gaugeaction
+
+    global G_latt_LO_flow_storage
+    if identifier not in G_latt_LO_flow_storage.keys():
+
+        G_PERT_LO_DIR = get_pert_LO_dir()
+        file = G_PERT_LO_DIR+"/"+corr+"_pert_latt_"+flowaction+"_"+gaugeaction+"_Nt"+str(Nt)+".dat"
+        flowtimes_file = G_PERT_LO_DIR+"/flowtimes.dat"
+        spline_file = file[:-len(".dat")]+"_spline.bin"
+        try:
+            source_mtimes = [os.path.getmtime(file), os.path.getmtime(flowtimes_file)]
+        except OSError:
+            print("Error in latt_LO_flow: could not load file ", file, "or", flowtimes_file)
+            exit(1)
+
+        spline = None
+        if os.path.isfile(spline_file):
+            attrs, arrays = open_container(spline_file, mode='c')
+            if attrs.get('source_mtimes') == source_mtimes:
+                spline = scipy.interpolate.BSpline.construct_fast(arrays['knots'], arrays['coefficients'], attrs['degree'], axis=0)
+
+        if spline is None:
+            flowtimes = numpy.loadtxt(flowtimes_file)
+            tmp = numpy.loadtxt(file)
+            spline = scipy.interpolate.make_interp_spline(flowtimes, tmp, k=3, axis=0)
+            try:
+                _save_G_latt_LO_flow_spline(spline_file, flowtimes, spline, dict(corr=corr, Nt=Nt, flowaction=flowaction, gaugeaction=gaugeaction,
+                                                                                   degree=spline.k, source_mtimes=source_mtimes))
+            except OSError:
+                print("WARN: could not write", spline_file, ", the spline is only kept in memory")
+
+        G_latt_LO_flow_storage[identifier] = spline
+
+    return G_latt_LO_flow_storage[identifier]
+
+
+def G_latt_LO_flow_all_taus(flowtime, corr: str, Nt: int, flowaction: str, gaugeaction: str):
+    """ the perturbative LO correlator under flow at all tau indices at once, i.e. G_latt_LO_flow for tau_index = 0, ..., Nt/2-1.
+    returns an array of shape numpy.shape(flowtime) + (Nt/2,). """
+    spline = get_G_latt_LO_flow_spline(corr, Nt, flowaction, gaugeaction)
+    flowtime = numpy.asarray(flowtime)
+    if numpy.any(flowtime < spline.t[0]) or numpy.any(flowtime > spline.t[-1]):
+        raise ValueError("Error in latt_LO_flow: flow time outside of the range of the tabulated data")
+    return spline(flowtime)
 
 
 def G_latt_LO_flow(tau_index: int, flowtime, corr: str, Nt: int, flowaction: str, gaugeaction: str):
@@ -185,33 +523,22 @@ def G_latt_LO_flow(tau_index: int, flowtime, corr: str, Nt: int, flowaction: str
 
     flowtime is given units of lattice spacing squared.
     """
+    return G_latt_LO_flow_all_taus(flowtime, corr, Nt, flowaction, gaugeaction)[..., tau_index]
 
-    identifier = str(Nt)+flowaction+gaugeaction
 
-    G_PERT_LO_DIR = os.environ['G_PERT_LO_DIR']
-    if not G_PERT_LO_DIR:
-        # print("Warn: environment variable G_PERT_LO_DIR is not set, using default path")
-        G_PERT_LO_DIR = "/work/home/altenkort/work/correlators_flow/data/merged/pert_LO/"
-
-    # store for future access
-    global G_latt_LO_flow_storage
-    if identifier not in G_latt_LO_flow_storage.keys():
+def get_tree_level_normalization(flowtimes, corr: str, Nt: int, flowaction: str, gaugeaction: str):
+    """ the factors Nt^4/G_latt_LO_flow of shape (len(flowtimes), Nt/2) that normalize the correlator at the given flow times (units of lattice
+    spacing squared) at all tau indices. they are computed once per flow time grid and then stored in a global dictionary (read-only). """
+    flowtimes = numpy.atleast_1d(numpy.asarray(flowtimes, dtype=float))
+    identifier = (corr, Nt, flowaction, gaugeaction, flowtimes.tobytes())
 
-        file = G_PERT_LO_DIR+"/"+corr+"_pert_latt_"+flowaction+"_"+gaugeaction+"_Nt"+str(Nt)+".dat"
-        flowtimes = numpy.loadtxt(G_PERT_LO_DIR+"/flowtimes.dat")
-        try:
-            tmp = numpy.loadtxt(file)
-        except OSError:
-            print("Error in latt_LO_flow: could not load file ", file)
-            exit(1)
-        interpolations = []
-        for i in range(tmp.shape[1]):
-            interpolations.append(scipy.interpolate.InterpolatedUnivariateSpline(flowtimes, tmp[:, i], k=3, ext=2))
-        G_latt_LO_flow_storage[identifier] = interpolations
+    global G_latt_LO_norm_storage
+    if identifier not in G_latt_LO_norm_storage.keys():
+        norm = Nt**4 / G_latt_LO_flow_all_taus(flowtimes, corr, Nt, flowaction, gaugeaction)
+        norm.setflags(write=False)
+        G_latt_LO_norm_storage[identifier] = norm
 
-    # return the corresponding flowtime-interpolated correlator evaluated at the given flowtime(s)
-    this_int = G_latt_LO_flow_storage[identifier][tau_index]
-    return this_int(flowtime)
+    return G_latt_LO_norm_storage[identifier]
 
 
 def lower_tauT_limit_(flowradius, max_FlowradiusBytauT=numpy.sqrt(8*0.014), tauT_offset=0):  # note: sqrt(8*0.014) ~= 0.33
@@ -228,6 +555,63 @@ ToverTc = {16: 1.510424, 20: 1.473469, 24: 1.484769, 30: 1.511761, 36: 1.504171}
 
 # === plotting ===
 
+def get_figure_page_path(pdf_path, index):
+    return pdf_path[:-len(".pdf")] + "_pages/" + str(index).zfill(5) + ".pdf"
+
+
+def prepare_figure_pages(pdf_path):
+    """ create the (empty) folder for the pages of pdf_path that are written by save_figure_page """
+    folder = os.path.dirname(get_figure_page_path(pdf_path, 0))
+    create_folder(folder)
+    for file in os.listdir(folder):
+        os.remove(os.path.join(folder, file))
+
+
+def save_figure_page(fig, pdf_path, index):
+    """ save fig as page number index of pdf_path into a file of its own and close it. this can be called by many processes at once, see
+    prepare_figure_pages and stitch_figure_pages. """
+    set_rc_params()
+    fig.savefig(get_figure_page_path(pdf_path, index))
+    matplotlib.pyplot.close(fig)
+
+
+def can_stitch_figure_pages():
+    """ whether the optional pypdf is available, which stitch_figure_pages needs """
+    try:
+        import pypdf
+    except ImportError:
+        return False
+    return True
+
+
+def stitch_figure_pages(pdf_path, n_pages):
+    """ combine the pages of pdf_path that were written by save_figure_page into pdf_path (needs pypdf, see can_stitch_figure_pages) """
+    import pypdf
+    pages = [get_figure_page_path(pdf_path, i) for i in range(n_pages) if os.path.isfile(get_figure_page_path(pdf_path, i))]
+    folder = os.path.dirname(get_figure_page_path(pdf_path, 0))
+    print("saving ", pdf_path)
+    writer = pypdf.PdfWriter()
+    for page in pages:
+        writer.append(page)
+    with open(pdf_path, 'wb') as outfile:
+        writer.write(outfile)
+    for page in pages:
+        os.remove(page)
+    os.rmdir(folder)
+
+
+def save_figures(figs, pdf_path):
+    """ save figs (Nones are skipped) as the pages of pdf_path and close them """
+    from matplotlib.backends.backend_pdf import PdfPages
+    print("saving ", pdf_path)
+    set_rc_params()
+    with PdfPages(pdf_path) as pdf:
+        for fig in figs:
+            if fig is not None:
+                pdf.savefig(fig)
+                matplotlib.pyplot.close(fig)
+
+
 def get_color(myarray, i, start=0, end=-1, scale_factor=0.9):
     if myarray[end] == myarray[start]:
         return matplotlib.cm.gnuplot(0)
@@ -361,45 +745,244 @@ def create_figure(xlims=None, ylims=None, xlabel="", ylabel="", xlabelpos=(0.98,
     return fig, ax, axtwiny
 
 
-# class that is used in parallel_function_eval down below
-class ComputationClass:
-    def __init__(self, function, input_array, nproc, *add_param):
-        self._nproc = nproc  # number of processes
-        self._input_array = input_array
-        self._function = function
+# numpy arrays among the additional parameters of parallel_function_eval that have at least this size are copied to shared memory once per pool,
+# instead of being pickled for the workers
+shared_memory_min_bytes = 2**20
 
-        # additional arguments for actual_computation
-        self._add_param = add_param
 
-        # compute the result when class is initialized
-        self._result = self.parallelization_wrapper()
+class _SharedArray:
+    """ picklable reference to a numpy array in a shared memory block """
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
 
-    def parallelization_wrapper(self):
-        results = []
-        single_return_value = False
-        with concurrent.futures.ProcessPoolExecutor(max_workers=self._nproc) as executor:
-            for result in executor.map(self.pass_argument_wrapper, self._input_array):
-                if type(result) is tuple:
-                    results.append(list(result))
-                else:
-                    results.append(result)
-                    single_return_value = True
-        if single_return_value:
-            return results
-        else:
-            return list(map(list, zip(*results)))  # "transpose" the list to allow for multiple return values like a normal function.
 
-    def pass_argument_wrapper(self, single_input):
-        return self._function(single_input, *self._add_param)
+def _create_shared_array(shape, dtype, blocks):
+    from multiprocessing import shared_memory
+    dtype = numpy.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(int(numpy.prod(shape)) * dtype.itemsize, 1))
+    blocks.append(block)
+    return _SharedArray(block.name, tuple(shape), dtype.str), numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
 
-    def getResult(self):
-        return self._result
 
+def _attach_shared_array(reference, writeable, blocks):
+    from multiprocessing import shared_memory
+    block = shared_memory.SharedMemory(name=reference.name)
+    blocks.append(block)  # the block has to stay open as long as the array is used
+    array = numpy.ndarray(reference.shape, dtype=reference.dtype, buffer=block.buf)
+    array.setflags(write=writeable)
+    return array
 
-# in parallel, compute function(input_array)
-def parallel_function_eval(function, input_array, nproc, *add_param):
-    computer = ComputationClass(function, input_array, nproc, *add_param)
-    return computer.getResult()
+
+# state of a worker process of a WorkerPool. it is set up lazily by the first chunk of each call and then reused by the following chunks of that call.
+_worker_state = {}
+
+# ids of the calls of WorkerPool.map, to tell the workers when they have to set up their state again
+_call_ids = itertools.count()
+
+
+def _set_up_worker(call_id, function, add_param, out, figures):
+    old_blocks = _worker_state.get('blocks', [])
+    _worker_state.clear()
+    for block in old_blocks:
+        try:
+            block.close()
+        except BufferError:  # the function kept a view of the array. the block is released when the worker exits.
+            pass
+    blocks = []
+    _worker_state['call_id'] = call_id
+    _worker_state['blocks'] = blocks
+    _worker_state['function'] = function
+    _worker_state['add_param'] = [_attach_shared_array(param, False, blocks) if isinstance(param, _SharedArray) else param for param in add_param]
+    _worker_state['out'] = None if out is None else [None if buffer is None else _attach_shared_array(buffer, True, blocks) for buffer in out]
+    _worker_state['figures'] = figures
+
+
+def _call_in_worker(index, single_input):
+    result = _worker_state['function'](single_input, *_worker_state['add_param'])
+    out = _worker_state['out']
+    figures = _worker_state['figures']
+    if out is None and figures is None:
+        return result
+    single_return_value = type(result) is not tuple
+    values = [result] if single_return_value else result
+    out = [None] * len(values) if out is None else out
+    figures = [None] * len(values) if figures is None else figures
+    # results that have a buffer are written to it and figures are saved as pages, only the others are sent back
+    returned = []
+    for buffer, pdf_path, value in zip(out, figures, values):
+        if buffer is not None:
+            buffer[index] = value
+            returned.append(None)
+        elif pdf_path is not None:
+            if value is not None:
+                save_figure_page(value, pdf_path, index)
+            returned.append(None)
+        else:
+            returned.append(value)
+    return returned[0] if single_return_value else tuple(returned)
+
+
+def _run_chunk(call_id, setup, chunk):
+    if _worker_state.get('call_id') != call_id:
+        _set_up_worker(call_id, *setup)
+    return [_call_in_worker(index, single_input) for index, single_input in chunk]
+
+
+class WorkerPool:
+    """ pool of nproc worker processes that is reused by several calls of parallel_function_eval, e.g. by all stages of a script:
+
+        with lpd.WorkerPool(args.nproc) as pool:
+            results = lpd.parallel_function_eval(function, input_array, args.nproc, *add_param, pool=pool)
+
+    the workers are started on first use and set up for each call by its first chunk of inputs. the inputs are sent in chunks of chunksize elements
+    (default: about four chunks per worker and call). arrays returned by share() are placed in shared memory once and are then passed to all calls
+    without copying them again. """
+
+    def __init__(self, nproc, chunksize=None):
+        self._nproc = nproc
+        self._chunksize = chunksize
+        self._executor = None
+        self._blocks = []
+        self._shared = {}  # id of an array returned by share -> (array, reference)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def share(self, array):
+        """ returns a copy of array in shared memory that stays there until the pool is closed """
+        array = numpy.asarray(array)
+        reference, shared = _create_shared_array(array.shape, array.dtype, self._blocks)
+        shared[...] = array
+        self._shared[id(shared)] = (shared, reference)
+        return shared
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._shared = {}
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:  # an array returned by share is still in use
+                pass
+            block.unlink()
+        self._blocks = []
+
+    def _to_reference(self, param, blocks):
+        if not isinstance(param, numpy.ndarray):
+            return param
+        if id(param) in self._shared and self._shared[id(param)][0] is param:
+            return self._shared[id(param)][1]
+        if param.nbytes >= shared_memory_min_bytes:
+            reference, shared = _create_shared_array(param.shape, param.dtype, blocks)
+            shared[...] = param
+            return reference
+        return param
+
+    def map(self, function, input_array, *add_param, out=None, figures=None, chunksize=None):
+        """ see parallel_function_eval """
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self._nproc)
+        inputs = list(enumerate(input_array))
+        n = len(inputs)
+        if chunksize is None:
+            chunksize = self._chunksize if self._chunksize is not None else max(1, -(-n // (4 * self._nproc)))
+
+        single_out = out is not None and not isinstance(out, (tuple, list))
+        out = [out] if single_out else out
+        figures = [figures] if isinstance(figures, str) else figures
+        # the workers can only save the figures themselves if their pages can be stitched together afterwards. otherwise they are sent back and
+        # saved here.
+        worker_figures = figures if figures is not None and can_stitch_figure_pages() else None
+        for pdf_path in worker_figures if worker_figures is not None else []:
+            if pdf_path is not None:
+                prepare_figure_pages(pdf_path)
+        results = [None] * n
+        columns = None
+        single_return_value = False
+        blocks = []
+        futures = []
+        try:
+            # large arrays among the additional parameters and all output buffers are placed in shared memory for this call
+            setup_add_param = [self._to_reference(param, blocks) for param in add_param]
+            out_references, out_shared = None, None
+            if out is not None:
+                out_references, out_shared = [], []
+                for buffer in out:
+                    reference, shared = (None, None) if buffer is None else _create_shared_array(buffer.shape, buffer.dtype, blocks)
+                    out_references.append(reference)
+                    out_shared.append(shared)
+            shared = None
+
+            call_id = next(_call_ids)
+            setup = (function, setup_add_param, out_references, worker_figures)
+            futures = [self._executor.submit(_run_chunk, call_id, setup, inputs[start:start + chunksize]) for start in range(0, n, chunksize)]
+            for start, future in zip(range(0, n, chunksize), futures):
+                for index, result in enumerate(future.result(), start):
+                    if type(result) is tuple:
+                        # allow for multiple return values like a normal function: one list (or output array) per return value
+                        if columns is None:
+                            columns = [[None] * n for _ in result]
+                        for column, value in zip(columns, result):
+                            column[index] = value
+                    else:
+                        results[index] = result
+                        single_return_value = True
+
+            if out is not None:
+                for buffer, shared in zip(out, out_shared):
+                    if buffer is not None:
+                        buffer[...] = shared
+            for i, pdf_path in enumerate(figures if figures is not None else []):
+                if pdf_path is None:
+                    continue
+                if worker_figures is not None:
+                    stitch_figure_pages(pdf_path, n)
+                else:
+                    column = results if single_return_value else columns[i] if columns is not None else []
+                    save_figures(column, pdf_path)
+                    column[:] = [None] * len(column)
+        finally:
+            for future in futures:
+                future.cancel()
+            setup_add_param, out_shared, shared, setup = None, None, None, None  # release the views before the blocks are closed
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        if single_out:
+            return out[0]
+        if single_return_value:
+            return results
+        if columns is None:
+            return []
+        if out is not None:
+            for i, buffer in enumerate(out):
+                if buffer is not None:
+                    columns[i] = buffer
+        return columns
+
+
+# in parallel, compute function(input_array).
+# numpy arrays in add_param are shared with the workers (read-only) instead of being copied for each of them if they are large.
+# out: optional preallocated array (or a tuple of arrays and Nones, one per return value of function) of which out[i] is set to (the
+# corresponding return value of) function(input_array[i]). these results are written directly to shared memory by the workers instead of being
+# sent back, and the arrays are returned in place of the lists of results.
+# figures: optional pdf file (or a tuple of files and Nones, one per return value). the returned figures are then saved by the workers as pages of
+# this file (see save_figure_page) and closed instead of being sent back. without the optional pypdf to stitch these pages together, the figures are
+# sent back and saved to the file in the main process instead. in both cases they are replaced by None in the results.
+# pool: optional WorkerPool that is reused instead of starting nproc new workers. chunksize: number of inputs per task.
+def parallel_function_eval(function, input_array, nproc, *add_param, out=None, figures=None, pool=None, chunksize=None):
+    if pool is not None:
+        return pool.map(function, input_array, *add_param, out=out, figures=figures, chunksize=chunksize)
+    with WorkerPool(nproc, chunksize) as pool:
+        return pool.map(function, input_array, *add_param, out=out, figures=figures)
 
 
 def serial_function_eval(function, input_array, *add_param):
@@ -438,6 +1021,250 @@ def dev_by_dist(data, axis=0, return_both_q=False, percentile=68):
         return numpy.max(numpy.stack((numpy.abs(q_l), numpy.abs(q_r)), axis=0), axis=0)
 
 
+# === integrated autocorrelation time ===
+
+def get_autocorrelation_fft(ts):
+    """ normalized autocorrelation function rho(t) = Gamma(t)/Gamma(0) of all time series at once. the first axis is the Monte Carlo time,
+    Gamma(t) = 1/(N-t) sum_i (x_i - xbar)(x_(i+t) - xbar) is computed via FFT for all t. """
+    ts = numpy.asarray(ts, dtype=float)
+    n = len(ts)
+    nfft = 2**int(numpy.ceil(numpy.log2(2*n)))
+    centered = ts - numpy.mean(ts, axis=0)
+    transformed = numpy.fft.rfft(centered, n=nfft, axis=0)
+    autocov = numpy.fft.irfft(transformed * numpy.conj(transformed), n=nfft, axis=0)[:n]
+    autocov /= (n - numpy.arange(n)).reshape(-1, *[1] * (ts.ndim - 1))
+    with numpy.errstate(all='ignore'):
+        rho = autocov / autocov[0]
+    # constant time series are not correlated
+    return numpy.where(autocov[0] > 0, rho, (numpy.arange(n) == 0).reshape(-1, *[1] * (ts.ndim - 1)))
+
+
+def get_tauint_fft(ts, S=1.5):
+    """ integrated autocorrelation time of all time series at once (the first axis is the Monte Carlo time), using the automatic windowing
+    procedure of U. Wolff, Comput. Phys. Commun. 156 (2004) 143, with the error estimate and the bias from the mean given there.
+    tau_int follows the convention of latqcdtools getTauInt, tau_int = 1 + 2 sum_(t=1)^W rho(t), which is twice the one of Wolff, such that
+    int(tau_int) is a sensible bin length. returns (tau_int, tau_inte, tau_intbias, window) with the shape of the remaining axes. a window of
+    len(ts)-1 means that the windowing did not converge, i.e. the time series is too short. """
+    ts = numpy.asarray(ts, dtype=float)
+    n = len(ts)
+    shape = ts.shape[1:]
+    ts = ts.reshape(n, -1)
+    results = numpy.empty((4, ts.shape[1]))
+    if n < 2:
+        results[:] = [[1], [0], [0], [0]]
+        return tuple(result.reshape(shape) for result in results)
+    window_sizes = numpy.arange(1, n)[:, None]
+    chunk = max(1, int(2**24 / n))  # the fft needs a few copies of (2n, chunk)
+    for i in range(0, ts.shape[1], chunk):
+        tau_wolff = 0.5 + numpy.cumsum(get_autocorrelation_fft(ts[:, i:i+chunk])[1:], axis=0)
+        with numpy.errstate(all='ignore'):
+            tau = numpy.where(tau_wolff > 0.5, S / numpy.log((2 * tau_wolff + 1) / (2 * tau_wolff - 1)), 1e-8)
+            g = numpy.exp(-window_sizes / tau) - tau / numpy.sqrt(window_sizes * n)
+        window_index = numpy.where((g < 0).any(axis=0), numpy.argmax(g < 0, axis=0), n - 2)
+        tau_wolff = tau_wolff[window_index, numpy.arange(tau_wolff.shape[1])]
+        window = window_index + 1
+        results[0, i:i+chunk] = 2 * tau_wolff
+        results[1, i:i+chunk] = 2 * tau_wolff * 2 * numpy.sqrt(numpy.fmax(window + 0.5 - tau_wolff, 0) / n)
+        results[2, i:i+chunk] = 2 * tau_wolff * (2 * window + 1) / n
+        results[3, i:i+chunk] = window
+    return tuple(result.reshape(shape) for result in results)
+
+
+def get_tauint_vs_start(ts, starts, S=1.5):
+    """ tau_int of ts[start:] for many start indices at once, e.g. to find where a stream is thermalized. the results are the same as those of
+    get_tauint_fft(ts[start:]) for each start, but instead of computing the autocorrelation function for every start, the lagged products are
+    summed up from the end of the time series once per lag and evaluated for all starts. the loop over the lags stops as soon as the windows of
+    all starts are found, so the cost is about (length of ts) * (largest window). returns (tau_int, tau_inte, tau_intbias, window) over the starts. """
+    x = numpy.asarray(ts, dtype=float)
+    x = x - numpy.mean(x)  # numerically more stable sums
+    n = len(x)
+    starts = numpy.asarray(starts, dtype=int)
+    nconf = n - starts
+    cumsum = numpy.concatenate(([0], numpy.cumsum(x)))
+    mean = (cumsum[n] - cumsum[starts]) / nconf
+
+    def autocov(t):
+        # 1/(N-t) sum_(i=start)^(n-1-t) (x_i - mean)(x_(i+t) - mean) for all starts that have at least one pair
+        valid = starts < n - t
+        s = starts[valid]
+        npairs = n - t - s
+        products = numpy.concatenate(([0], numpy.cumsum(x[:n-t] * x[t:])))
+        result = numpy.zeros(len(starts))
+        result[valid] = (products[n-t] - products[s] - mean[valid] * (cumsum[n-t] - cumsum[s] + cumsum[n] - cumsum[s+t])) / npairs + mean[valid]**2
+        return result
+
+    autocov0 = autocov(0)
+    tau_wolff = numpy.full(len(starts), 0.5)
+    results = numpy.empty((4, len(starts)))
+    results[:, nconf < 2] = [[1], [0], [0], [0]]
+    todo = nconf >= 2
+    for t in range(1, n):
+        if not todo.any():
+            break
+        with numpy.errstate(all='ignore'):
+            tau_wolff[todo] += numpy.where(autocov0[todo] > 0, autocov(t)[todo] / autocov0[todo], 0)
+            tau = numpy.where(tau_wolff > 0.5, S / numpy.log((2 * tau_wolff + 1) / (2 * tau_wolff - 1)), 1e-8)
+            g = numpy.exp(-t / tau) - tau / numpy.sqrt(t * nconf)
+        # the window is found, or the windowing did not converge until the largest possible window
+        done = todo & ((g < 0) | (t == nconf - 1))
+        results[0, done] = 2 * tau_wolff[done]
+        results[1, done] = 2 * tau_wolff[done] * 2 * numpy.sqrt(numpy.fmax(t + 0.5 - tau_wolff[done], 0) / nconf[done])
+        results[2, done] = 2 * tau_wolff[done] * (2 * t + 1) / nconf[done]
+        results[3, done] = t
+        todo &= ~done
+    return tuple(results)
+
+
+# === counter-based random numbers ===
+
+def get_rng(dataset_id, sample_index):
+    """ random number generator for one sample of a data set. it is based on the counter-based Philox generator, whose key is derived from
+    dataset_id (e.g. a string that names the data set) and whose counter starts at sample_index. the random numbers of a sample therefore do not
+    depend on which other samples are generated, in which order, or on which process or machine. """
+    key = numpy.frombuffer(hashlib.blake2b(str(dataset_id).encode(), digest_size=16).digest(), dtype=numpy.uint64)
+    return numpy.random.Generator(numpy.random.Philox(key=key, counter=[0, 0, 0, sample_index]))
+
+
+def gaussian_samples(mean, std_dev, sample_indices, dataset_id):
+    """ samples of shape (len(sample_indices), *mean.shape) drawn from independent normal distributions around mean with width std_dev """
+    mean, std_dev = numpy.asarray(mean, dtype=float), numpy.asarray(std_dev, dtype=float)
+    noise = numpy.asarray([get_rng(dataset_id, i).standard_normal(mean.shape) for i in sample_indices]).reshape(-1, *mean.shape)
+    return mean + std_dev * noise
+
+
+def gaussian_bootstrap(function, data, data_std_dev, n_samples, dataset_id, nproc=1, args=(), return_sample=False):
+    """ replacement for latqcdtools.statistics.bootstr.bootstr_from_gauss with sample_size=1 and err_by_dist=True, based on gaussian_samples.
+    returns the median and dev_by_dist of function(sample, *args) over the samples (and the results of all samples if return_sample). """
+    samples = gaussian_samples(data, data_std_dev, range(n_samples), dataset_id)
+    if nproc > 1:
+        results = numpy.asarray(parallel_function_eval(function, samples, nproc, *args))
+    else:
+        results = numpy.asarray(serial_function_eval(function, samples, *args))
+    if return_sample:
+        return results, numpy.median(results, axis=0), dev_by_dist(results, axis=0)
+    return numpy.median(results, axis=0), dev_by_dist(results, axis=0)
+
+
+# === bootstrap of ratios of means ===
+
+def bootstrap_indices(n, sample_indices, dataset_id, sample_size=None):
+    """ the random conf indices of the given bootstrap samples, drawn from get_rng(dataset_id, i) for each sample i """
+    sample_size = n if sample_size is None else sample_size
+    return numpy.asarray([get_rng(dataset_id, i).integers(0, n, size=sample_size) for i in sample_indices]).reshape(-1, sample_size)
+
+
+def bootstrap_count_matrix(n, sample_indices, dataset_id, sample_size=None):
+    """ (len(sample_indices), n) matrix that contains how often each conf is drawn in each bootstrap sample """
+    indices = bootstrap_indices(n, sample_indices, dataset_id, sample_size)
+    offsets = indices + n * numpy.arange(len(indices))[:, None]
+    return numpy.bincount(offsets.ravel(), minlength=len(indices)*n).reshape(len(indices), n).astype(float)
+
+
+def iter_bootstrap_mean_ratio(numerator, denominator, n_samples, dataset_id=0, sample_size=None, block_size=None):
+    """ bootstrap samples of mean(numerator)/mean(denominator), where the means are taken over the first axis (the confs) and the shapes of the
+    means have to be broadcastable. instead of resampling the data for every sample, the means of a block of samples are computed at once as
+    (count matrix) @ data. yields (first sample index, samples of this block) for blocks of block_size samples. as the draws of each sample only
+    depend on dataset_id and the sample index, any block of samples can be computed separately. """
+    n = len(numerator)
+    sample_size = n if sample_size is None else sample_size
+    numerator_shape, denominator_shape = numpy.shape(numerator)[1:], numpy.shape(denominator)[1:]
+    numerator = numpy.asarray(numerator, dtype=float).reshape(n, -1)
+    denominator = numpy.asarray(denominator, dtype=float).reshape(n, -1)
+    if block_size is None:
+        block_size = max(1, min(n_samples, int(2**22 / (n + numerator.shape[1]))))
+    for start in range(0, n_samples, block_size):
+        counts = bootstrap_count_matrix(n, range(start, min(start + block_size, n_samples)), dataset_id, sample_size)
+        numerator_mean = (counts @ numerator) / sample_size
+        denominator_mean = (counts @ denominator) / sample_size
+        yield start, numerator_mean.reshape(-1, *numerator_shape) / denominator_mean.reshape(-1, *denominator_shape)
+
+
+def bootstrap_mean_ratio(numerator, denominator, n_samples, dataset_id=0, sample_size=None, block_size=None):
+    """ all samples of iter_bootstrap_mean_ratio in one array of shape (n_samples, ...) """
+    return numpy.concatenate([samples for _, samples in iter_bootstrap_mean_ratio(numerator, denominator, n_samples, dataset_id, sample_size,
+                                                                                  block_size)])
+
+
+class CovarianceAccumulator:
+    """ streaming estimate of the covariance and correlation matrix of the last axis of blocks of samples of shape (nsamples, ..., nvar). blocks are
+    merged with the pairwise update of Chan et al., so only the mean and the comoment matrices are kept in memory.
+    if band is given, only the covariances of variables that are at most band apart are kept, in the banded storage of shape (..., nvar, 2*band+1)
+    where [..., i, band+d] belongs to the variables i and i+d (nan if i+d is out of range). see band_to_dense. """
+    def __init__(self, band=None):
+        self.band = band
+        self.n = 0
+        self.mean = None
+        self.comoment = None
+
+    def _products(self, a, b):
+        # sum over the first axis of the products of all (or all nearby) pairs of variables
+        if self.band is None:
+            return numpy.matmul(numpy.moveaxis(a, 0, -1), numpy.moveaxis(b, 0, -2))
+        nvar = a.shape[-1]
+        result = numpy.full((*a.shape[1:], 2 * self.band + 1), numpy.nan)
+        for k, d in enumerate(range(-self.band, self.band + 1)):
+            lo, hi = max(0, -d), min(nvar, nvar - d)
+            result[..., lo:hi, k] = numpy.sum(a[..., lo:hi] * b[..., lo+d:hi+d], axis=0)
+        return result
+
+    def add(self, block):
+        block = numpy.asarray(block, dtype=float)
+        n_block = len(block)
+        if n_block == 0:
+            return
+        mean_block = numpy.mean(block, axis=0)
+        centered = block - mean_block
+        comoment_block = self._products(centered, centered)
+        if self.n == 0:
+            self.n, self.mean, self.comoment = n_block, mean_block, comoment_block
+            return
+        n = self.n + n_block
+        delta = mean_block - self.mean
+        self.comoment += comoment_block + self._products(delta[None], delta[None]) * (self.n * n_block / n)
+        self.mean += delta * n_block / n
+        self.n = n
+
+    def covariance(self, ddof=1):
+        return self.comoment / (self.n - ddof)
+
+    def correlation(self):
+        """ same as numpy.corrcoef of the samples of each variable """
+        if self.band is None:
+            stddev = numpy.sqrt(numpy.diagonal(self.comoment, axis1=-2, axis2=-1))
+            return numpy.clip(self.comoment / (stddev[..., :, None] * stddev[..., None, :]), -1, 1)
+        stddev = numpy.sqrt(self.comoment[..., self.band])[None]
+        ones = numpy.ones_like(stddev)
+        # the products with ones give the stddev of variable i and of variable i+d in the banded storage
+        return numpy.clip(self.comoment / (self._products(stddev, ones) * self._products(ones, stddev)), -1, 1)
+
+
+def band_to_dense(banded):
+    """ full (..., nvar, nvar) matrix (nan outside of the band) from the banded storage of CovarianceAccumulator """
+    nvar, band = banded.shape[-2], (banded.shape[-1] - 1) // 2
+    dense = numpy.full((*banded.shape[:-1], nvar), numpy.nan)
+    for k, d in enumerate(range(-band, band + 1)):
+        i = numpy.arange(max(0, -d), min(nvar, nvar - d))
+        dense[..., i, i + d] = banded[..., i, k]
+    return dense
+
+
+def save_flow_covariance(filename, accumulator):
+    """ save the covariance and correlation of a CovarianceAccumulator (with the flow times as variables) such that tools can load them with
+    load_flow_covariance instead of recomputing them from the samples """
+    numpy.savez(filename, covariance=accumulator.covariance(), correlation=accumulator.correlation(), n_samples=accumulator.n,
+                band=-1 if accumulator.band is None else accumulator.band)
+
+
+def load_flow_covariance(filename, dense=True):
+    """ covariance and correlation saved by save_flow_covariance. banded ones are converted to full matrices with nan outside of the band, unless
+    dense=False. """
+    with numpy.load(filename) as file:
+        covariance, correlation, band = file['covariance'], file['correlation'], int(file['band'])
+    if band >= 0 and dense:
+        covariance, correlation = band_to_dense(covariance), band_to_dense(correlation)
+    return covariance, correlation
+
+
 def print_var(prefix, var):
     print(prefix, var)
     return var
@@ -1,15 +1,10 @@
 #!/usr/bin/env python3
 import numpy
-from latqcdtools.statistics import bootstr
 import lib_process_data as lpd
 import correlator_analysis.double_extrapolation._4_continuum_extr as ce
 import scipy
 
 
-def identity(input):
-    return input
-
-
 def interpolation(Ntaus, tauT_data, corr_data, corr_err_data, output_tauTs, nsamples):
     output_tauT_len = len(output_tauTs)
 
@@ -22,7 +17,7 @@ def interpolation(Ntaus, tauT_data, corr_data, corr_err_data, output_tauTs, nsam
         edata = corr_err_data[i]
 
         # generate mock bootstrap samples
-        samples, _, _ = bootstr.bootstr_from_gauss(identity, ydata, edata, nsamples, return_sample=True)
+        samples = lpd.gaussian_samples(ydata, edata, range(nsamples), "multi-level_2015/Nt" + str(Ntau))
 
         # result variables
         theoutputdata = []
@@ -57,8 +52,8 @@ def cont_extr(Ntaus, tauT_data, corr_data, corr_err_data, output_tauTs, nsamples
     for j in range(output_tauT_len):
         ydata = [interpolation[0][j] for interpolation in interpolations]
         edata = [interpolation[1][j] for interpolation in interpolations]
-        fitparams, fitparams_err = bootstr.bootstr_from_gauss(ce.fit_sample, data=ydata, data_std_dev=edata, numb_samples=nsamples,
-                                                              sample_size=1, return_sample=False, args=[xdata, edata, [0, 3]])
+        fitparams, fitparams_err = lpd.gaussian_bootstrap(ce.fit_sample, ydata, edata, nsamples, "multi-level_2015/cont/" + str(output_tauTs[j]),
+                                                          args=[xdata, edata, [0, 3]])
 
         cont_corr[j] = fitparams[1]
         cont_corr_err[j] = fitparams_err[1]